@@ -0,0 +1,319 @@
+"""
+Drives the API routes in-process against the configured database and reports latency percentiles,
+throughput and database queries per request for each, optionally writing them as JSON to diff between commits
+
+Reads use existing ratings, so seed a scratch database first (python -m courator seed). Writes go to a
+throwaway university and accounts that are removed afterwards
+
+Usage: python benchmarks/endpoints.py [--requests 200] [--concurrency 8] [--only rating] [--output results.json]
+"""
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from datetime import datetime
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import httpx
+import numpy as np
+
+from courator import app, db
+from courator.routes import encode_account_token
+from courator.schemas import PERM_ADMIN, PERM_USER
+from courator.seed import SEED_PASSWORD
+from courator.serialization import orjson
+
+SAMPLE_COUNT = 100
+BULK_COURSES_PER_REQUEST = 100
+BULK_RATINGS_PER_REQUEST = 10
+# Routes that depend on outside websites or permanently change shared data
+SKIPPED = {
+    ('GET', '/university/{university_code}/course/{course_code}/metadata'),
+    ('GET', '/icon/{icon_hash}'),
+    ('POST', '/ratingAttribute'),
+}
+
+
+class Scenario(NamedTuple):
+    name: str
+    method: str
+    route: str
+    # Keyword arguments for client.request given the request number and the run's values
+    make_request: Callable[[int, dict], dict]
+    # Earlier scenarios that create what this one's requests use, run first even when not selected
+    needs: Tuple[str, ...] = ()
+
+
+def get(path: str, **params) -> Callable[[int, dict], dict]:
+    def make_request(i: int, values: dict) -> dict:
+        sample = values['samples'][i % len(values['samples'])]
+        return dict(url=path.format(i=i, **values, **sample), params={
+            key: value.format(i=i, **values, **sample) for key, value in params.items()
+        })
+    return make_request
+
+
+def rating_body(values: dict, description: str) -> dict:
+    return dict(
+        ratings=[dict(id=str(attribute_id), value=3) for attribute_id in values['attributeIDs']],
+        overallRating=4, description=description
+    )
+
+
+SCENARIOS = [
+    Scenario('list universities', 'GET', '/university', get('/university')),
+    Scenario('search universities', 'GET', '/university', get('/university', name='{universityCode}')),
+    Scenario('get university', 'GET', '/university/{university_code}', get('/university/{universityCode}')),
+    Scenario('autocomplete', 'GET', '/autocomplete', get('/autocomplete', q='{courseCode}')),
+    Scenario('list courses', 'GET', '/university/{university_code}/course',
+             get('/university/{universityCode}/course')),
+    Scenario('search courses', 'GET', '/university/{university_code}/course',
+             get('/university/{universityCode}/course', query='{courseTitle}')),
+    Scenario('get course', 'GET', '/university/{university_code}/course/{course_code}',
+             get('/university/{universityCode}/course/{courseCode}')),
+    Scenario('get ratings', 'GET', '/university/{university_code}/course/{course_code}/rating',
+             get('/university/{universityCode}/course/{courseCode}/rating')),
+    Scenario('list rating attributes', 'GET', '/ratingAttribute', get('/ratingAttribute')),
+    Scenario('rating correlation', 'GET', '/ratingCorrelation', get('/ratingCorrelation')),
+    Scenario('get own account', 'GET', '/account', get('/account')),
+    Scenario('get account', 'GET', '/account/{account_id}', get('/account/{accountID}')),
+    Scenario('suggestions', 'GET', '/account/{account_id}/suggestions', get('/account/{accountID}/suggestions')),
+    Scenario('cache stats', 'GET', '/cacheStats', get('/cacheStats')),
+    Scenario('export universities', 'GET', '/export/{kind}', get('/export/university')),
+    Scenario('login', 'POST', '/token', lambda i, values: dict(
+        url='/token', data=dict(username=values['email'], password=SEED_PASSWORD)
+    )),
+    Scenario('create account', 'POST', '/account', lambda i, values: dict(
+        url='/account', json=dict(name='Bench {}'.format(i), password=SEED_PASSWORD,
+                                  email='{}-{}@example.edu'.format(values['run'].lower(), i))
+    )),
+    Scenario('create university', 'POST', '/university', lambda i, values: dict(
+        url='/university', json=dict(code='{}U{}'.format(values['run'], i), name='Bench University {}'.format(i),
+                                     description='', website='')
+    )),
+    Scenario('update university', 'PUT', '/university/{university_code}', lambda i, values: dict(
+        url='/university/{}U{}'.format(values['run'], i),
+        json=dict(code='{}U{}'.format(values['run'], i), name='Renamed University {}'.format(i), description='',
+                  website='')
+    ), needs=('create university',)),
+    Scenario('delete university', 'DELETE', '/university/{university_code}', lambda i, values: dict(
+        url='/university/{}U{}'.format(values['run'], i)
+    ), needs=('create university',)),
+    Scenario('create course', 'POST', '/university/{university_code}/course', lambda i, values: dict(
+        url='/university/{}/course'.format(values['run']),
+        json=dict(code='BCH{}'.format(i), title='Bench Course {}'.format(i), description='', website='')
+    )),
+    Scenario('update course', 'PUT', '/university/{university_code}/course/{course_code}', lambda i, values: dict(
+        url='/university/{}/course/BCH{}'.format(values['run'], i),
+        json=dict(title='Updated Course {}'.format(i), description='Updated', website='')
+    ), needs=('create course',)),
+    Scenario('submit rating', 'POST', '/university/{university_code}/course/{course_code}/rating',
+             lambda i, values: dict(url='/university/{}/course/BCH{}/rating'.format(values['run'], i),
+                                    json=rating_body(values, 'Bench review {}'.format(i))),
+             needs=('create course',)),
+    Scenario('bulk courses', 'POST', '/university/{university_code}/course:bulk', lambda i, values: dict(
+        url='/university/{}/course:bulk'.format(values['run']),
+        json=[dict(code='BLK{}'.format(i * BULK_COURSES_PER_REQUEST + j), title='Bulk Course', description='',
+                   website='') for j in range(BULK_COURSES_PER_REQUEST)]
+    )),
+    Scenario('bulk ratings', 'POST', '/ratings:bulk', lambda i, values: dict(
+        url='/ratings:bulk',
+        json=[dict(rating_body(values, 'Bulk review'), universityCode=values['run'],
+                   courseCode='BLK{}'.format(i * BULK_RATINGS_PER_REQUEST + j))
+              for j in range(BULK_RATINGS_PER_REQUEST)]
+    ), needs=('bulk courses',)),
+    Scenario('delete course', 'DELETE', '/university/{university_code}/course/{course_code}', lambda i, values: dict(
+        url='/university/{}/course/BCH{}'.format(values['run'], i)
+    ), needs=('create course',)),
+]
+
+
+async def get_samples() -> list:
+    """Rated courses with the university code, a word of the title and an account that rated each"""
+    rows = await db.fetch_all(
+        'SELECT University.code, Course.code, Course.title, CourseRating.accountID FROM CourseRating '
+        'JOIN University ON University.id = CourseRating.universityID '
+        'JOIN Course ON Course.universityID = CourseRating.universityID AND Course.code = CourseRating.courseCode '
+        'ORDER BY CourseRating.id DESC LIMIT :limit',
+        dict(limit=SAMPLE_COUNT)
+    )
+    return [
+        dict(universityCode=row[0], courseCode=row[1], courseTitle=row[2].split()[-1], accountID=row[3])
+        for row in rows
+    ]
+
+
+async def set_up(client: httpx.AsyncClient, run: str) -> dict:
+    """Create the admin account and university the write scenarios use"""
+    email = '{}@example.edu'.format(run.lower())
+    r = await client.post('/account', json=dict(name='Bench', email=email, password=SEED_PASSWORD))
+    r.raise_for_status()
+    account_id = r.json()['id']
+    await db.execute('UPDATE Account SET permissions = :permissions WHERE id = :id',
+                     dict(permissions=PERM_ADMIN | PERM_USER, id=account_id))
+    client.headers['Authorization'] = 'Bearer {}'.format(encode_account_token(account_id))
+    r = await client.post('/university', json=dict(code=run, name='Bench University', description='', website=''))
+    r.raise_for_status()
+    attributes = (await client.get('/ratingAttribute')).json()
+    return dict(run=run, email=email, accountID=account_id, universityID=r.json()['id'],
+                attributeIDs=[attribute['id'] for attribute in attributes if not attribute['name'].startswith('_')])
+
+
+async def tear_down(values: dict):
+    """Remove everything the write scenarios created, including rows the API has no route to delete"""
+    university_id = values['universityID']
+    account_ids = [row[0] for row in await db.fetch_all(
+        'SELECT id FROM Account WHERE email LIKE :email', dict(email='{}%@example.edu'.format(values['run'].lower()))
+    )]
+    async with db.transaction():
+        await db.execute(
+            'DELETE CourseRatingValue FROM CourseRatingValue '
+            'JOIN CourseRating ON CourseRating.id = CourseRatingValue.courseRatingID '
+            'WHERE CourseRating.universityID = :id', dict(id=university_id)
+        )
+        for table in ['CourseRating', 'CourseRatingAggregate', 'Course']:
+            await db.execute('DELETE FROM {} WHERE universityID = :id'.format(table), dict(id=university_id))
+        await db.execute('DELETE FROM University WHERE id = :id OR code LIKE :code',
+                         dict(id=university_id, code='{}U%'.format(values['run'])))
+        for account_id in account_ids:
+            await db.execute('DELETE FROM Account WHERE id = :id', dict(id=account_id))
+        await db.execute('DELETE FROM EntityVersion WHERE entity LIKE :course OR entity LIKE :rating',
+                         dict(course='course:{}%'.format(values['run'].lower()),
+                              rating='rating:{}%'.format(values['run'].lower())))
+
+
+async def run_scenario(client: httpx.AsyncClient, scenario: Scenario, values: dict, requests: int,
+                       concurrency: int) -> dict:
+    latencies = []
+    statuses = Counter()
+    queries = []
+    next_request = iter(range(requests))
+
+    async def worker():
+        for i in next_request:
+            kwargs = scenario.make_request(i, values)
+            start = time.perf_counter()
+            r = await client.request(scenario.method, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            statuses[r.status_code] += 1
+
+    # Scenarios run one at a time, so every query made meanwhile belongs to one, including batched
+    # loader queries and background tasks
+    listener = lambda query, args, duration: queries.append(duration)
+    db.listeners.append(listener)
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    finally:
+        db.listeners.remove(listener)
+    elapsed = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return dict(
+        method=scenario.method, route=scenario.route, requests=requests,
+        errors=sum(count for code, count in statuses.items() if code >= 400),
+        statuses={str(code): count for code, count in sorted(statuses.items())},
+        p50_ms=round(p50, 3), p95_ms=round(p95, 3), p99_ms=round(p99, 3),
+        mean_ms=round(float(np.mean(latencies)) * 1000, 3),
+        throughput_rps=round(requests / elapsed, 1),
+        queries_per_request=round(len(queries) / requests, 2),
+        query_ms_per_request=round(sum(queries) * 1000 / requests, 3),
+    )
+
+
+def with_needs(scenarios: List[Scenario]) -> List[Scenario]:
+    """The scenarios plus those they need, in SCENARIOS order"""
+    names = {scenario.name for scenario in scenarios}
+    for scenario in reversed(SCENARIOS):
+        if scenario.name in names:
+            names.update(scenario.needs)
+    return [scenario for scenario in SCENARIOS if scenario.name in names]
+
+
+def get_uncovered(scenarios: List[Scenario]) -> list:
+    covered = {(scenario.method, scenario.route) for scenario in scenarios} | SKIPPED
+    return sorted(
+        '{} {}'.format(method, route.path)
+        for route in app.routes if getattr(route, 'methods', None) and route.path.startswith('/')
+        for method in route.methods
+        if method in ('GET', 'POST', 'PUT', 'DELETE') and (method, route.path) not in covered
+        and not route.path.startswith(('/docs', '/redoc', '/openapi'))
+    )
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(name: str, result: dict):
+    print('{:<24} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>8.2f} {:>7}'.format(
+        name, result['p50_ms'], result['p95_ms'], result['p99_ms'], result['throughput_rps'],
+        result['queries_per_request'], result['errors']
+    ))
+
+
+async def run(requests: int, concurrency: int, only: str, warmup: int) -> dict:
+    scenarios = [scenario for scenario in SCENARIOS if only in scenario.name]
+    run_id = 'BENCH{}'.format(int(time.time()))
+    results = {}
+    async with app.router.lifespan_context(app):
+        samples = await get_samples()
+        if not samples:
+            print('Database needs course ratings to benchmark with, run "python -m courator seed" first')
+            raise SystemExit(1)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench') as client:
+            values = await set_up(client, run_id)
+            values['samples'] = samples
+            print('{:<24} {:>9} {:>9} {:>9} {:>9} {:>8} {:>7}'.format(
+                'scenario', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'queries', 'errors'
+            ))
+            try:
+                for scenario in with_needs(scenarios):
+                    if scenario not in scenarios:
+                        print('{:<24} (run to create data for later scenarios)'.format(scenario.name))
+                        await run_scenario(client, scenario, values, requests, concurrency)
+                        continue
+                    if scenario.method == 'GET':
+                        for i in range(warmup):
+                            await client.request(scenario.method, **scenario.make_request(i, values))
+                    results[scenario.name] = await run_scenario(client, scenario, values, requests, concurrency)
+                    print_result(scenario.name, results[scenario.name])
+            finally:
+                await tear_down(values)
+    return results
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=10, help='Untimed requests before each read scenario')
+    parser.add_argument('--only', default='', help='Run scenarios whose name contains this')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.requests, args.concurrency, args.only, args.warmup))
+    uncovered = get_uncovered(SCENARIOS)
+    if uncovered:
+        print('Not covered: {}'.format(', '.join(uncovered)))
+    print('Skipped: {}'.format(', '.join(sorted('{} {}'.format(*route) for route in SKIPPED))))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(
+                meta=dict(commit=get_git_commit(), timestamp=datetime.utcnow().isoformat(), args=vars(args),
+                          encoder='orjson' if orjson else 'json'),
+                scenarios=results, uncovered=uncovered,
+            ), f, indent=2)
+        print('Wrote {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Compares the pydantic and fast response paths of get_courses and get_ratings on synthetic rows,
+end to end through FastAPI so response_model validation and JSON encoding are both included
+
+Usage: python benchmarks/serialization.py [--courses 5000] [--reviews 100] [--iterations 30]
+"""
+import asyncio
+import os
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from typing import List
+
+os.environ.setdefault('DB_CONNECTION', 'mysql://localhost/courator')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+import httpx
+from fastapi import FastAPI, Response
+
+from courator.routes import COURSE_FIELDS, course_list, course_rating_info
+from courator.schemas import Course, CourseRatingInfo
+from courator.serialization import orjson
+
+
+def make_course_rows(count: int) -> list:
+    values = dict(
+        title='Introduction to Something', description='A course about something. ' * 20,
+        website='https://example.edu/courses', professorID=None, universityID=1
+    )
+    return [tuple(dict(values, code='CS{}'.format(i))[field] for field in COURSE_FIELDS) for i in range(count)]
+
+
+def make_rating_rows(count: int, attributes: int = 5):
+    attribute_ratings = [(i, count, 0.5 + i / 20) for i in range(attributes)]
+    start = datetime(2020, 1, 1)
+    reviews = [
+        (i, 'Student {}'.format(i), 'student{}@example.edu'.format(i), 'About me', i,
+         'Review text. ' * 10, start + timedelta(hours=i))
+        for i in range(count)
+    ]
+    values = [(i, attribute, attribute / attributes) for i in range(count) for attribute in range(attributes)]
+    return attribute_ratings, reviews, values
+
+
+def add_routes(app: FastAPI, fast: bool, course_rows: list, rating_rows: tuple):
+    prefix = '/fast' if fast else '/pydantic'
+
+    @app.get(prefix + '/courses', response_model=List[Course])
+    async def courses(response: Response):
+        return course_list(course_rows, response, fast)
+
+    @app.get(prefix + '/ratings', response_model=CourseRatingInfo)
+    async def ratings(response: Response):
+        return course_rating_info(*rating_rows, None, response, fast)
+
+
+def make_app(course_rows: list, rating_rows: tuple) -> FastAPI:
+    app = FastAPI()
+    add_routes(app, False, course_rows, rating_rows)
+    add_routes(app, True, course_rows, rating_rows)
+    return app
+
+
+async def time_requests(client: httpx.AsyncClient, path: str, iterations: int) -> float:
+    await client.get(path)  # Warm up
+    start = time.perf_counter()
+    for _ in range(iterations):
+        r = await client.get(path)
+        r.raise_for_status()
+    return (time.perf_counter() - start) / iterations
+
+
+async def run(courses: int, reviews: int, iterations: int):
+    app = make_app(make_course_rows(courses), make_rating_rows(reviews))
+    print('Encoder: {}'.format('orjson' if orjson else 'json (install the "fast" extra for orjson)'))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench') as client:
+        for name, label in [('courses', '{} courses'.format(courses)), ('ratings', '{} reviews'.format(reviews))]:
+            slow_body = (await client.get('/pydantic/' + name)).json()
+            fast_body = (await client.get('/fast/' + name)).json()
+            assert slow_body == fast_body, 'Fast path output differs for ' + name
+            slow = await time_requests(client, '/pydantic/' + name, iterations)
+            fast = await time_requests(client, '/fast/' + name, iterations)
+            print('{:<14} pydantic {:8.2f} ms   fast {:8.2f} ms   {:5.1f}x'.format(
+                label, slow * 1000, fast * 1000, slow / fast
+            ))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--courses', type=int, default=5000)
+    parser.add_argument('--reviews', type=int, default=100)
+    parser.add_argument('--iterations', type=int, default=30)
+    args = parser.parse_args()
+    asyncio.run(run(args.courses, args.reviews, args.iterations))
+
+
+if __name__ == '__main__':
+    main()
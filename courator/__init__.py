@@ -1,19 +1,53 @@
 from typing import Tuple
 
-from databases import Database
 from fastapi import FastAPI
 
-from courator.config import DATABASE_URL, DEBUG
+from courator.config import DATABASE_URL, DB_REPLICAS, DEBUG, SNAPSHOT_PATH
+from courator.database import InstrumentedDatabase, open_snapshot
+from courator.replicas import ReplicatedDatabase, route_reads
 
 app = FastAPI()
-db = Database(DATABASE_URL)
+if SNAPSHOT_PATH:
+    db = open_snapshot(SNAPSHOT_PATH)
+elif DB_REPLICAS:
+    db = ReplicatedDatabase(DATABASE_URL, list(DB_REPLICAS))
+else:
+    db = InstrumentedDatabase(DATABASE_URL)
 
 
 def setup_globals():
+    from .hashing import start_hash_pool, stop_hash_pool
+    from .outbound import start_http_client, stop_http_client
+    from .recommend import load_recommendations, stop_recommendations
+    from .search import load_search_index, stop_search_index
+    from .autocomplete import load_autocomplete_index, stop_autocomplete_index
+    from .universities import load_university_ids, stop_university_ids
+    app.on_event("startup")(start_hash_pool)
+    app.on_event("startup")(start_http_client)
     app.on_event("startup")(db.connect)
+    if isinstance(db, ReplicatedDatabase):
+        app.on_event("startup")(db.start_replicas)
+        app.on_event("shutdown")(db.stop_replicas)
+        app.middleware('http')(route_reads)
+    app.on_event("startup")(load_university_ids)
+    app.on_event("startup")(load_recommendations)
+    app.on_event("startup")(load_search_index)
+    app.on_event("startup")(load_autocomplete_index)
+    app.on_event("shutdown")(stop_recommendations)
+    app.on_event("shutdown")(stop_search_index)
+    app.on_event("shutdown")(stop_autocomplete_index)
+    app.on_event("shutdown")(stop_university_ids)
+    app.on_event("shutdown")(stop_hash_pool)
+    app.on_event("shutdown")(stop_http_client)
     app.on_event("shutdown")(db.disconnect)
+    from .metrics import setup_metrics
     from .routes import router
     app.include_router(router)
+    if SNAPSHOT_PATH:
+        from .snapshot import reject_writes
+        app.middleware('http')(reject_writes)
+    # Added last so it is outermost and times the other middleware too
+    setup_metrics(app, db)
 
 
 setup_globals()
@@ -1,11 +1,22 @@
+import asyncio
 import json
+import os
+import sys
 from argparse import ArgumentParser
 
 import httpx
 import uvicorn
+from syncer import sync
 
 from courator import DEBUG
-from .sql_schemas import init_db, delete_db
+from courator.config import RECOMMENDATIONS_PATH, SNAPSHOT_PATH
+from .export import EXPORTS, MEDIA_TYPES as EXPORT_MEDIA_TYPES, export_db
+from .importer import import_courses
+from .metadata import prefetch_university_metadata
+from .recommend import build_recommendations
+from .seed import DEFAULT_ATTRIBUTES, seed_db
+from .snapshot import create_snapshot
+from .sql_schemas import init_db, delete_db, migrate_db, rebuild_aggregates_db
 
 
 def get_token(auth, server_url, existing_only=False):
@@ -28,14 +39,77 @@ def get_token(auth, server_url, existing_only=False):
     return r.json()['access_token']
 
 
+async def post_with_retries(client: httpx.AsyncClient, url: str, retries: int, **kwargs) -> httpx.Response:
+    for attempt in range(retries + 1):
+        try:
+            r = await client.post(url, **kwargs)
+            if r.status_code < 500 and r.status_code != 429:
+                return r
+            error = '{}: {}'.format(r.status_code, r.text)
+        except httpx.TransportError as e:
+            error = repr(e)
+        if attempt < retries:
+            print('Request failed ({}), retrying...'.format(error))
+            await asyncio.sleep(2 ** attempt)
+    raise RuntimeError(error)
+
+
+@sync
+async def upload_courses(url: str, courses: list, headers: dict, batch_size: int, concurrency: int,
+                         retries: int) -> bool:
+    """Upload courses through the bulk endpoint, returning whether every one was accepted"""
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def upload_batch(start: int, client: httpx.AsyncClient):
+        nonlocal failures
+        batch = courses[start:start + batch_size]
+        async with semaphore:
+            try:
+                r = await post_with_retries(client, url, retries, json=batch, headers=headers)
+            except RuntimeError as e:
+                print('Failed to upload courses {} to {}: {}'.format(start, start + len(batch) - 1, e))
+                failures += len(batch)
+                return
+        if r.is_error:
+            print('Failed to upload courses {} to {} ({}): {}'.format(start, start + len(batch) - 1, r.status_code,
+                                                                     r.text))
+            failures += len(batch)
+            return
+        for course, result in zip(batch, r.json()):
+            if result['status'] >= 400:
+                print('Failed to upload {} ({}): {}'.format(course['code'], result['status'], result['detail']))
+                failures += 1
+        print('Uploaded courses {} to {}'.format(start, start + len(batch) - 1))
+
+    async with httpx.AsyncClient(timeout=60) as client:
+        await asyncio.gather(*[upload_batch(start, client) for start in range(0, len(courses), batch_size)])
+    print('Uploaded {} of {} courses'.format(len(courses) - failures, len(courses)))
+    return failures == 0
+
+
 def main():
     parser = ArgumentParser(description='An app to rate and suggest university courses')
     sp = parser.add_subparsers(dest='action')
     sp.required = True
-    sp.add_parser('init')
+    p = sp.add_parser('init')
+    p.add_argument('--with-procedures', action='store_true', help='Also create the optional stored procedures')
     sp.add_parser('delete')
+    sp.add_parser('migrate', help='Apply schema changes made since the database was created')
+    sp.add_parser('check-queries', help='Fail if a read route runs a query that scans a whole table')
+    sp.add_parser('rebuild-aggregates', help='Recompute per-course rating aggregates from scratch')
+    p = sp.add_parser('build-recommendations', help='Precompute the course similarity matrix')
+    p.add_argument('-o', '--output', help='Directory to save the model to', default=RECOMMENDATIONS_PATH)
+    p = sp.add_parser('prefetch-metadata', help='Scrape and store metadata for every course of a university')
+    p.add_argument('university', help='University code to prefetch')
+    p.add_argument('-c', '--concurrency', help='Courses to fetch at once. Default: 4', type=int, default=4)
+    p.add_argument('-f', '--force', action='store_true', help='Refetch metadata that is not stale yet')
     p = sp.add_parser('run')
     p.add_argument('-p', '--port', help='Port to run on. Default: 8001', type=int, default=8001)
+    p.add_argument('--snapshot', help='Serve reads from this file made by the snapshot command and reject writes. '
+                                      'Setting SNAPSHOT_PATH does the same', default=SNAPSHOT_PATH)
+    p = sp.add_parser('snapshot', help='Copy the tables read routes use into an indexed SQLite file')
+    p.add_argument('output', help='File to write, replaced atomically when complete')
     p = sp.add_parser('load')
     p.add_argument('data_json',
                    help='JSON file with list of {"CourseNumber": "CS100", "CourseName": "", "CourseDescription": ""}')
@@ -43,14 +117,48 @@ def main():
     p.add_argument('auth', help='Authentication in form of username:password')
     p.add_argument('-e', '--existing-only', help="Don't create an account/university if they don't exist")
     p.add_argument('-s', '--server-url', help='URL of server to upload to', default='http://localhost:8001')
+    p.add_argument('-b', '--batch-size', help='Courses per request. Default: 1000', type=int, default=1000)
+    p.add_argument('-c', '--concurrency', help='Requests to make at once. Default: 4', type=int, default=4)
+    p.add_argument('-r', '--retries', help='Times to retry a failed request. Default: 3', type=int, default=3)
+    p = sp.add_parser('import', help='Stream a large course file into the database')
+    p.add_argument('--direct', action='store_true', required=True,
+                   help='Write straight to the database rather than through a server')
+    p.add_argument('data_json', help='JSON array or NDJSON file of courses in the format of load or the API')
+    p.add_argument('university', help='University code to import to')
+    p.add_argument('-b', '--batch-size', help='Courses per transaction. Default: 10000', type=int, default=10000)
+    p.add_argument('--checkpoint', help='Progress file to resume from. Default: DATA_JSON.checkpoint')
+    p = sp.add_parser('export', help='Stream a table out of the database')
+    p.add_argument('kind', choices=list(EXPORTS), help='What to export')
+    p.add_argument('-f', '--format', choices=list(EXPORT_MEDIA_TYPES), default='ndjson', help='Default: ndjson')
+    p.add_argument('-o', '--output', help='File to write to. Default: standard output')
+    p = sp.add_parser('seed', help='Generate universities, courses, accounts and ratings for benchmarking')
+    p.add_argument('-u', '--universities', help='Default: 10', type=int, default=10)
+    p.add_argument('-c', '--courses', help='Total across all universities. Default: 5000', type=int, default=5000)
+    p.add_argument('-r', '--ratings', help='Default: 100000', type=int, default=100000)
+    p.add_argument('-a', '--accounts', help='Default: one per 20 ratings', type=int)
+    p.add_argument('-p', '--prefix', help='Start of generated university codes and emails. Default: SEED',
+                   default='SEED')
+    p.add_argument('-s', '--seed', help='Random seed. Default: 0', type=int, default=0)
     p = sp.add_parser('add-default', help='Add default attributes')
     p.add_argument('-s', '--server-url', help='URL of server to upload to', default='http://localhost:8001')
     p.add_argument('auth', help='Authentication in form of username:password')
     args = parser.parse_args()
     if args.action == 'init':
-        init_db()
+        init_db(args.with_procedures)
     elif args.action == 'delete':
         delete_db()
+    elif args.action == 'migrate':
+        migrate_db()
+    elif args.action == 'check-queries':
+        from .query_check import check_queries
+        if not check_queries():
+            raise SystemExit(1)
+    elif args.action == 'rebuild-aggregates':
+        rebuild_aggregates_db()
+    elif args.action == 'build-recommendations':
+        build_recommendations(args.output)
+    elif args.action == 'prefetch-metadata':
+        prefetch_university_metadata(args.university, args.concurrency, args.force)
     elif args.action == 'load':
         with open(args.data_json) as f:
             courses = json.load(f)
@@ -67,31 +175,36 @@ def main():
                            headers=auth_headers)
             assert not r.is_error
 
-        for course in courses:
-            code = course['CourseNumber']
-            title = course['CourseName']
-            description = course['CourseDescription']
-            print('Uploading {}...'.format(code))
-            r = httpx.post(base + '/university/{}/course'.format(args.university),
-                           json=dict(code=code, title=title, description=description), headers=auth_headers)
-            if r.is_error:
-                print('Failed to upload ({}): {}'.format(r.status_code, r.content))
+        courses = [
+            dict(code=course['CourseNumber'], title=course['CourseName'], description=course['CourseDescription'])
+            for course in courses
+        ]
+        url = base + '/university/{}/course:bulk'.format(args.university)
+        if not upload_courses(url, courses, auth_headers, args.batch_size, args.concurrency, args.retries):
+            raise SystemExit(1)
+    elif args.action == 'import':
+        import_courses(args.data_json, args.university, args.batch_size, args.checkpoint)
+    elif args.action == 'export':
+        export_db(args.kind, args.format, args.output)
+    elif args.action == 'snapshot':
+        create_snapshot(args.output)
+    elif args.action == 'seed':
+        seed_db(args.universities, args.courses, args.ratings, args.accounts or max(args.ratings // 20, 1),
+                args.prefix, args.seed)
     elif args.action == 'add-default':
         base = args.server_url.rstrip('/')
         token = get_token(args.auth, args.server_url)
         auth_headers = {'Authorization': 'Bearer {}'.format(token)}
-        defaults_attributes = [
-            {'name': 'Difficulty', 'description': 'How hard you found the course'},
-            {'name': 'Curriculum', 'description': 'How well the course was layed out'},
-            {'name': 'Usefulness', 'description': 'How applicable the course is to the real world'},
-            {'name': '_Overall', 'description': 'Overall course rating'}
-        ]
-        for attr in defaults_attributes:
+        for attr in DEFAULT_ATTRIBUTES:
             print('Uploading attribute "{}"...'.format(attr['name']))
             r = httpx.post(base + '/ratingAttribute', json=attr, headers=auth_headers)
             if r.is_error:
                 print('Failed to upload attribute {} ({}): {}'.format(attr, r.status_code, r.content))
     elif args.action == 'run':
+        if args.snapshot != SNAPSHOT_PATH:
+            # The database is chosen when the package is imported, so start over configured for the snapshot
+            os.environ['SNAPSHOT_PATH'] = args.snapshot
+            os.execv(sys.executable, [sys.executable, '-m', 'courator'] + sys.argv[1:])
         log_level = 'info'
         reload = False
         if DEBUG:
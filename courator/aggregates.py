@@ -0,0 +1,36 @@
+from typing import Iterable, Tuple
+
+from . import db
+from .queries import insert_many
+
+
+async def add_to_aggregates(university_id: int, course_code: str, values: Iterable[Tuple[int, float]]):
+    """Fold new (attributeID, value) pairs of a course into CourseRatingAggregate"""
+    rows = [
+        dict(universityID=university_id, courseCode=course_code, attributeID=attribute_id,
+             ratingCount=1, valueSum=value, valueSquareSum=value * value)
+        for attribute_id, value in values
+    ]
+    if not rows:
+        return
+    await db.execute(*insert_many('CourseRatingAggregate', rows, (
+        'ON DUPLICATE KEY UPDATE '
+        'ratingCount = ratingCount + VALUES(ratingCount), '
+        'valueSum = valueSum + VALUES(valueSum), '
+        'valueSquareSum = valueSquareSum + VALUES(valueSquareSum)'
+    )))
+
+
+async def rebuild_aggregates():
+    """Recompute every aggregate row from CourseRating and CourseRatingValue"""
+    async with db.transaction():
+        await db.execute('DELETE FROM CourseRatingAggregate')
+        await db.execute(
+            'INSERT INTO CourseRatingAggregate '
+            '(universityID, courseCode, attributeID, ratingCount, valueSum, valueSquareSum) '
+            'SELECT cr.universityID, cr.courseCode, crv.courseRatingAttributeID, '
+            '   COUNT(crv.value), SUM(crv.value), SUM(crv.value * crv.value) '
+            'FROM CourseRatingValue crv '
+            'INNER JOIN CourseRating cr ON cr.id = crv.courseRatingID '
+            'GROUP BY cr.universityID, cr.courseCode, crv.courseRatingAttributeID'
+        )
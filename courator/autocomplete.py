@@ -0,0 +1,153 @@
+import asyncio
+import re
+from bisect import bisect_left, insort
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from . import db
+from .config import SEARCH_REFRESH_SECONDS
+
+MAX_SCANNED_KEYS = 500
+
+EntityKey = Tuple[int, int, str]  # (kind, universityID, courseCode), kind 0 for universities and 1 for courses
+UNIVERSITY = 0
+COURSE = 1
+
+
+def normalize(text: str) -> str:
+    return ' '.join(re.findall(r'[a-z0-9]+', text.lower()))
+
+
+def prefix_keys(*texts: str) -> List[str]:
+    """Every text plus each of its word-starting suffixes, so "alg" finds "Intro to Algorithms" """
+    keys = set()
+    for text in texts:
+        words = normalize(text).split(' ')
+        keys.update(' '.join(words[i:]) for i in range(len(words)))
+    keys.discard('')
+    return sorted(keys)
+
+
+class PrefixIndex:
+    """
+    Sorted (key, entity) pairs searched with bisect and patched in place on writes. Universities
+    and courses are kept apart so short prefixes matching many courses can't crowd universities out
+    """
+
+    def __init__(self):
+        self.keys = ([], [])  # type: Tuple[List[Tuple[str, EntityKey]], List[Tuple[str, EntityKey]]]
+        self.entity_keys = {}  # type: Dict[EntityKey, List[str]]
+        self.labels = {}  # type: Dict[EntityKey, Tuple[str, str]]
+        self.university_codes = {}  # type: Dict[int, str]
+
+    def add(self, entity: EntityKey, code: str, name: str, keep_sorted: bool = True):
+        """Index an entity. Bulk loads pass keep_sorted=False and call sort() once at the end"""
+        self.remove(entity)
+        keys = prefix_keys(code, name, re.sub(r'([A-Za-z])([0-9])', r'\1 \2', code))
+        kind_keys = self.keys[entity[0]]
+        for key in keys:
+            if keep_sorted:
+                insort(kind_keys, (key, entity))
+            else:
+                kind_keys.append((key, entity))
+        self.entity_keys[entity] = keys
+        self.labels[entity] = (code, name)
+
+    def remove(self, entity: EntityKey):
+        kind_keys = self.keys[entity[0]]
+        for key in self.entity_keys.pop(entity, []):
+            i = bisect_left(kind_keys, (key, entity))
+            if i < len(kind_keys) and kind_keys[i] == (key, entity):
+                del kind_keys[i]
+        self.labels.pop(entity, None)
+
+    def sort(self):
+        for kind_keys in self.keys:
+            kind_keys.sort()
+
+    def add_university(self, university_id: int, code: str, name: str, keep_sorted: bool = True):
+        self.university_codes[university_id] = code
+        self.add((UNIVERSITY, university_id, ''), code, name, keep_sorted)
+
+    def remove_university(self, university_id: int):
+        """Remove a university along with its courses"""
+        self.university_codes.pop(university_id, None)
+        self.remove((UNIVERSITY, university_id, ''))
+        for entity in [entity for entity in self.labels if entity[0] == COURSE and entity[1] == university_id]:
+            self.remove(entity)
+
+    def remove_university_code(self, code: str):
+        for university_id, university_code in list(self.university_codes.items()):
+            if university_code == code:
+                self.remove_university(university_id)
+
+    def add_course(self, university_id: int, code: str, title: str, keep_sorted: bool = True):
+        self.add((COURSE, university_id, code), code, title, keep_sorted)
+
+    def remove_course(self, university_id: int, code: str):
+        self.remove((COURSE, university_id, code))
+
+    def complete(self, query: str, count: int) -> List[dict]:
+        """
+        Best matches for a prefix: universities before courses, then matches on
+        the code or start of the name before mid-name ones, then shorter names
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        ranked = {}
+        for kind_keys in self.keys:
+            start = bisect_left(kind_keys, (query,))
+            for key, entity in kind_keys[start:start + MAX_SCANNED_KEYS]:
+                if not key.startswith(query):
+                    break
+                code, name = self.labels[entity]
+                is_start = key in (normalize(code), normalize(name))
+                rank = (entity[0], not is_start, len(name), name)
+                ranked[entity] = min(ranked.get(entity, rank), rank)
+        results = []
+        for entity in sorted(ranked, key=ranked.get)[:count]:
+            kind, university_id, _ = entity
+            code, name = self.labels[entity]
+            results.append(dict(
+                type='university' if kind == UNIVERSITY else 'course',
+                code=code, name=name, universityCode=self.university_codes.get(university_id, '')
+            ))
+        return results
+
+
+index = PrefixIndex()
+_refresh_task = None  # type: Optional[asyncio.Future]
+
+
+async def rebuild_autocomplete_index():
+    global index
+    new_index = PrefixIndex()
+    for university_id, code, name in await db.fetch_all('SELECT id, code, name FROM University'):
+        new_index.add_university(university_id, code, name, keep_sorted=False)
+    for university_id, code, title in await db.fetch_all('SELECT universityID, code, title FROM Course'):
+        new_index.add_course(university_id, code, title, keep_sorted=False)
+    new_index.sort()
+    index = new_index
+
+
+async def refresh_loop():
+    # Picks up universities and courses written through other worker processes
+    while True:
+        await asyncio.sleep(SEARCH_REFRESH_SECONDS)
+        try:
+            await rebuild_autocomplete_index()
+        except Exception:
+            logger.exception('Failed to refresh autocomplete index')
+
+
+async def load_autocomplete_index():
+    global _refresh_task
+    await rebuild_autocomplete_index()
+    _refresh_task = asyncio.ensure_future(refresh_loop())
+
+
+async def stop_autocomplete_index():
+    if _refresh_task:
+        _refresh_task.cancel()
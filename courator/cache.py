@@ -0,0 +1,45 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+caches = {}  # type: Dict[str, TTLCache]
+
+
+class TTLCache:
+    """In-process LRU cache whose entries also expire after ttl seconds, if given"""
+
+    def __init__(self, name: str, maxsize: int, ttl: Optional[float] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # type: OrderedDict[Hashable, tuple]
+        self.hits = 0
+        self.misses = 0
+        caches[name] = self
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.data.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires is None or expires > time.monotonic():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any):
+        self.data[key] = (None if self.ttl is None else time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses, size=len(self.data), maxsize=self.maxsize)
@@ -0,0 +1,74 @@
+import hashlib
+from typing import List, Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from . import db
+from .cache import TTLCache
+from .config import VERSION_CACHE_SECONDS
+from .queries import in_clause, insert_many
+
+# How long a worker trusts its copy of a counter. Bumps made by this worker apply
+# immediately, bumps made by other workers are seen after at most this long
+_versions = TTLCache('versions', maxsize=100000, ttl=VERSION_CACHE_SECONDS)
+
+UNIVERSITY_ENTITY = 'university'
+RATING_ATTRIBUTE_ENTITY = 'ratingAttribute'  # Also covers usage counts, so bumped by every rating
+
+
+def course_entity(university_code: str) -> str:
+    return 'course:{}'.format(university_code.lower())
+
+
+def rating_entity(university_code: str, course_code: str) -> str:
+    return 'rating:{}:{}'.format(university_code.lower(), course_code.lower())
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header value matches an ETag, using weak comparison"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tag = etag[2:] if etag.startswith('W/') else etag
+    return any(
+        (candidate[2:] if candidate.startswith('W/') else candidate) == tag
+        for candidate in (i.strip() for i in if_none_match.split(','))
+    )
+
+
+async def get_versions(entities: List[str]) -> List[int]:
+    missing = [entity for entity in entities if _versions.get(entity) is None]
+    if missing:
+        entities_sql, entities_args = in_clause('entity', missing)
+        found = dict(await db.fetch_all(
+            'SELECT entity, version FROM EntityVersion WHERE entity IN ' + entities_sql, entities_args
+        ))
+        for entity in missing:
+            _versions.set(entity, found.get(entity, 0))
+    return [_versions.get(entity, 0) for entity in entities]
+
+
+async def bump_versions(*entities: str):
+    """Mark entities as changed so validators issued for them stop matching"""
+    await db.execute(*insert_many(
+        'EntityVersion', [dict(entity=entity, version=1) for entity in set(entities)],
+        'ON DUPLICATE KEY UPDATE version = version + 1'
+    ))
+    for entity in entities:
+        _versions.invalidate(entity)
+
+
+async def check_not_modified(request: Request, response: Response, *entities: str) -> Optional[Response]:
+    """
+    Set an ETag derived from the request and the versions of the entities it reads.
+    Returns a 304 response to send instead when the client already has that version
+    """
+    versions = await get_versions(list(entities))
+    digest = hashlib.sha1(repr((request.url.path, request.url.query, versions)).encode()).hexdigest()
+    etag = 'W/"{}"'.format(digest[:20])
+    if etag_matches(request.headers.get('if-none-match', ''), etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    response.headers['ETag'] = etag
+    return None
@@ -1,17 +1,42 @@
 import logging
 
 from databases import DatabaseURL
-from starlette.config import Config
-from starlette.datastructures import Secret
+from starlette.config import Config, undefined
+from starlette.datastructures import CommaSeparatedStrings, Secret
 
 from .logging import setup_logging
 
 config = Config(".env")
 DEBUG = config("DEBUG", cast=bool, default=False)
-DATABASE_URL: DatabaseURL = config("DB_CONNECTION", cast=DatabaseURL)
+# Serve reads from a file made by "courator snapshot" instead, in which case DB_CONNECTION is optional
+SNAPSHOT_PATH: str = config("SNAPSHOT_PATH", default="")
+DATABASE_URL: DatabaseURL = config("DB_CONNECTION", cast=DatabaseURL, default=None if SNAPSHOT_PATH else undefined)
+DB_REPLICAS: CommaSeparatedStrings = config("DB_REPLICAS", cast=CommaSeparatedStrings, default="")
+# Replicas further behind than this are skipped. Clients read from the primary for PRIMARY_STICKY_SECONDS
+# after writing, which should cover the lag allowed plus the time to notice it
+REPLICA_MAX_LAG_SECONDS: float = config("REPLICA_MAX_LAG_SECONDS", cast=float, default=5.0)
+REPLICA_CHECK_SECONDS: float = config("REPLICA_CHECK_SECONDS", cast=float, default=2.0)
+PRIMARY_STICKY_SECONDS: float = config("PRIMARY_STICKY_SECONDS", cast=float, default=10.0)
 SECRET_KEY: Secret = config("SECRET_KEY", cast=Secret)
 TOKEN_EXPIRATION_DAYS: float = config("TOKEN_EXPIRATION_DAYS", cast=float, default=60.0)
 TOKEN_ALGORITHM = "HS256"
+PUBLIC_URL: str = config("PUBLIC_URL", default="")
+BCRYPT_ROUNDS: int = config("BCRYPT_ROUNDS", cast=int, default=12)
+HASH_WORKERS: int = config("HASH_WORKERS", cast=int, default=2)
+HASH_QUEUE_SIZE: int = config("HASH_QUEUE_SIZE", cast=int, default=32)
+ACCOUNT_CACHE_SIZE: int = config("ACCOUNT_CACHE_SIZE", cast=int, default=10000)
+ACCOUNT_CACHE_SECONDS: float = config("ACCOUNT_CACHE_SECONDS", cast=float, default=60.0)
+RECOMMENDATIONS_PATH: str = config("RECOMMENDATIONS_PATH", default="recommendations")
+RECOMMENDATIONS_REFRESH_SECONDS: float = config("RECOMMENDATIONS_REFRESH_SECONDS", cast=float, default=60.0)
+FAST_RESPONSES: bool = config("FAST_RESPONSES", cast=bool, default=False)
+MAX_PAGE_SIZE: int = config("MAX_PAGE_SIZE", cast=int, default=100)
+VERSION_CACHE_SECONDS: float = config("VERSION_CACHE_SECONDS", cast=float, default=1.0)
+METADATA_MAX_AGE_DAYS: float = config("METADATA_MAX_AGE_DAYS", cast=float, default=30.0)
+OUTBOUND_TIMEOUT_SECONDS: float = config("OUTBOUND_TIMEOUT_SECONDS", cast=float, default=5.0)
+OUTBOUND_MAX_CONNECTIONS: int = config("OUTBOUND_MAX_CONNECTIONS", cast=int, default=50)
+OUTBOUND_PER_HOST_LIMIT: int = config("OUTBOUND_PER_HOST_LIMIT", cast=int, default=4)
+OUTBOUND_RATE_PER_SECOND: float = config("OUTBOUND_RATE_PER_SECOND", cast=float, default=10.0)
+SEARCH_REFRESH_SECONDS: float = config("SEARCH_REFRESH_SECONDS", cast=float, default=300.0)
 
 setup_logging(
     ("uvicorn.asgi", "uvicorn.access"),
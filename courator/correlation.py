@@ -0,0 +1,66 @@
+from typing import List, Tuple
+
+import numpy as np
+
+from . import db
+from .cache import TTLCache
+
+# Ratings invalidate the worker that took them, so the TTL bounds how stale other workers can be
+CORRELATION_CACHE_SECONDS = 60
+
+_cache = TTLCache('correlations', maxsize=1024, ttl=CORRELATION_CACHE_SECONDS)
+
+
+def compute_correlations(rows: List[Tuple[int, int, float]], overall_id: int) -> List[Tuple[int, float]]:
+    """
+    Correlate each attribute with the overall rating across one account's ratings
+
+    Each row is (courseRatingID, attributeID, value). Values are standardized per attribute
+    and the correlation is the mean product with the standardized overall value over the
+    ratings that have both, matching the compute_correlation stored procedure.
+    """
+    if not rows:
+        return []
+    data = np.array(rows, dtype=float)
+    rating_ids, rating_idx = np.unique(data[:, 0], return_inverse=True)
+    attr_ids, attr_idx = np.unique(data[:, 1].astype(int), return_inverse=True)
+    overall_cols = np.flatnonzero(attr_ids == overall_id)
+    if not len(overall_cols):
+        return []
+
+    values = np.full((len(rating_ids), len(attr_ids)), np.nan)
+    values[rating_idx, attr_idx] = data[:, 2]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normed = (values - np.nanmean(values, axis=0)) / np.nanstd(values, axis=0)
+        products = normed * normed[:, overall_cols]
+        counts = np.count_nonzero(~np.isnan(products), axis=0)
+        correlations = np.nansum(products, axis=0) / counts
+    return [
+        (int(attr_id), float(correlation))
+        for attr_id, correlation in zip(attr_ids, correlations)
+        if attr_id != overall_id and np.isfinite(correlation)
+    ]
+
+
+async def get_account_correlations(account_id: int) -> List[Tuple[int, float]]:
+    correlations = _cache.get(account_id)
+    if correlations is not None:
+        return correlations
+    rows = await db.fetch_all(
+        'SELECT cr.id, crv.courseRatingAttributeID, crv.value, cra.name '
+        'FROM CourseRating cr '
+        'INNER JOIN CourseRatingValue crv ON crv.courseRatingID = cr.id '
+        'INNER JOIN CourseRatingAttribute cra ON cra.id = crv.courseRatingAttributeID '
+        'WHERE cr.accountID = :accountID',
+        dict(accountID=account_id)
+    )
+    overall_ids = {attr_id for _, attr_id, _, name in rows if name == '_Overall'}
+    correlations = []
+    if overall_ids:
+        correlations = compute_correlations([row[:3] for row in rows], overall_ids.pop())
+    _cache.set(account_id, correlations)
+    return correlations
+
+
+def invalidate_account_correlations(account_id: int):
+    _cache.invalidate(account_id)
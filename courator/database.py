@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import time
+from datetime import datetime
+from typing import Callable, List, Optional
+from urllib.parse import quote
+
+from databases import Database
+
+QueryListener = Callable[[str, Optional[dict], float], None]
+AcquireListener = Callable[[float], None]
+
+
+class InstrumentedDatabase(Database):
+    """
+    Database that reports every statement it runs, with its values and duration, to its listeners,
+    and how long each wait for a pooled connection took to its acquire_listeners
+    """
+
+    def __init__(self, url, **options):
+        super().__init__(url, **options)
+        self.listeners = []  # type: List[QueryListener]
+        self.acquire_listeners = []  # type: List[AcquireListener]
+
+    @property
+    def pool(self):
+        """The aiomysql pool while connected, which databases doesn't otherwise expose"""
+        pool = getattr(self._backend, '_pool', None)
+        return pool if hasattr(pool, 'freesize') else None
+
+    async def connect(self):
+        if self.is_connected:
+            return
+        await super().connect()
+        pool = self.pool
+        if pool is not None:
+            acquire = pool.acquire
+
+            async def timed_acquire():
+                start = time.perf_counter()
+                try:
+                    return await acquire()
+                finally:
+                    duration = time.perf_counter() - start
+                    for listener in self.acquire_listeners:
+                        listener(duration)
+            pool.acquire = timed_acquire
+
+    def report(self, query, values: Optional[dict], start: float):
+        duration = time.perf_counter() - start
+        for listener in self.listeners:
+            listener(str(query), values, duration)
+
+    async def fetch_all(self, query, values: dict = None):
+        start = time.perf_counter()
+        try:
+            return await super().fetch_all(query, values)
+        finally:
+            self.report(query, values, start)
+
+    async def fetch_one(self, query, values: dict = None):
+        start = time.perf_counter()
+        try:
+            return await super().fetch_one(query, values)
+        finally:
+            self.report(query, values, start)
+
+    async def fetch_val(self, query, values: dict = None, column=0):
+        start = time.perf_counter()
+        try:
+            return await super().fetch_val(query, values, column=column)
+        finally:
+            self.report(query, values, start)
+
+    async def execute(self, query, values: dict = None):
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, values)
+        finally:
+            self.report(query, values, start)
+
+    async def execute_many(self, query, values: list):
+        start = time.perf_counter()
+        try:
+            return await super().execute_many(query, values)
+        finally:
+            self.report(query, values[0] if values else None, start)
+
+    async def iterate(self, query, values: dict = None):
+        start = time.perf_counter()
+        try:
+            async for record in super().iterate(query, values):
+                yield record
+        finally:
+            self.report(query, values, start)
+
+
+def open_snapshot(path: str) -> InstrumentedDatabase:
+    """
+    Read-only database for a file made by "courator snapshot". It is opened as immutable, so replace the
+    file rather than writing to it to publish a new snapshot
+    """
+    # DATETIME columns hold MySQL's format as text, read back as datetimes like aiomysql returns
+    sqlite3.register_converter('DATETIME', lambda value: datetime.strptime(value.decode(), '%Y-%m-%d %H:%M:%S'))
+    return InstrumentedDatabase(
+        'sqlite:///file:{}?mode=ro&immutable=1'.format(quote(os.path.abspath(path))),
+        uri=True, detect_types=sqlite3.PARSE_DECLTYPES
+    )
@@ -0,0 +1,101 @@
+import csv
+import io
+import json
+import sys
+from datetime import date, datetime
+from typing import AsyncIterator, List, Tuple
+
+from syncer import sync
+
+from . import db
+
+CHUNK_SIZE = 1000
+
+# Exportable tables as (table, columns, key columns to page through them in order)
+EXPORTS = dict(
+    university=('University', ['id', 'code', 'name', 'description', 'website'], ['id']),
+    course=('Course', ['universityID', 'code', 'departmentCode', 'title', 'description', 'website', 'professorID'],
+            ['universityID', 'code']),
+    rating=('CourseRating', ['id', 'universityID', 'courseCode', 'accountID', 'date', 'description'], ['id']),
+    ratingValue=('CourseRatingValue', ['id', 'courseRatingID', 'courseRatingAttributeID', 'value'], ['id']),
+)
+MEDIA_TYPES = dict(ndjson='application/x-ndjson', csv='text/csv')
+
+
+def keyset_condition(keys: List[str]) -> str:
+    """(a, b) > (:a, :b) spelled out so MySQL can use the key as a range"""
+    terms = []
+    for i, key in enumerate(keys):
+        terms.append('({})'.format(' AND '.join(
+            ['{0} = :{0}'.format(prev) for prev in keys[:i]] + ['{0} > :{0}'.format(key)]
+        )))
+    return ' OR '.join(terms)
+
+
+async def iterate_table(table: str, columns: List[str], keys: List[str]) -> AsyncIterator[Tuple]:
+    """
+    Every row of a table in key order. The MySQL driver buffers whole results even when
+    iterating, so rows are read in keyset-paged chunks to keep memory flat
+    """
+    key_indexes = [columns.index(key) for key in keys]
+    last = None
+    while True:
+        query = 'SELECT {} FROM {}'.format(', '.join(columns), table)
+        args = dict(limit=CHUNK_SIZE)
+        if last is not None:
+            query += ' WHERE ' + keyset_condition(keys)
+            args.update(zip(keys, last))
+        query += ' ORDER BY {} LIMIT :limit'.format(', '.join(keys))
+        count = 0
+        async for row in db.iterate(query, args):
+            row = tuple(row)
+            count += 1
+            last = [row[i] for i in key_indexes]
+            yield row
+        if count < CHUNK_SIZE:
+            return
+
+
+def iterate_rows(kind: str) -> AsyncIterator[Tuple]:
+    return iterate_table(*EXPORTS[kind])
+
+
+def to_json(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError('Cannot serialize {}'.format(type(value).__name__))
+
+
+async def export_lines(kind: str, fmt: str) -> AsyncIterator[str]:
+    """An export as NDJSON or CSV, a chunk of lines at a time"""
+    columns = EXPORTS[kind][1]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(columns)
+    count = 0
+    async for row in iterate_rows(kind):
+        if fmt == 'csv':
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(columns, row)), default=to_json))
+            buffer.write('\n')
+        count += 1
+        if count % CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+@sync
+async def export_db(kind: str, fmt: str, output: str = None):
+    f = open(output, 'w', newline='') if output else sys.stdout
+    try:
+        async with db:
+            async for lines in export_lines(kind, fmt):
+                f.write(lines)
+    finally:
+        if output:
+            f.close()
@@ -0,0 +1,67 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi import status
+from passlib.context import CryptContext
+
+from .config import BCRYPT_ROUNDS, HASH_WORKERS, HASH_QUEUE_SIZE
+
+_executor = None  # type: Optional[ProcessPoolExecutor]
+_pending = 0
+
+
+@lru_cache(1)
+def get_pwd_context(rounds: int) -> CryptContext:
+    # Pinning min and max rounds makes hashes of any other cost report that they need an update
+    return CryptContext(
+        schemes=["bcrypt"], deprecated="auto",
+        bcrypt__default_rounds=rounds, bcrypt__min_rounds=rounds, bcrypt__max_rounds=rounds
+    )
+
+
+def _hash(password: str, rounds: int) -> str:
+    return get_pwd_context(rounds).hash(password)
+
+
+def _verify_and_update(password: str, password_hash: str, rounds: int) -> Tuple[bool, Optional[str]]:
+    return get_pwd_context(rounds).verify_and_update(password, password_hash)
+
+
+async def run_in_pool(func, *args):
+    """Run a hashing function in the worker pool, rejecting with 503 instead of queueing unboundedly"""
+    global _pending, _executor
+    if _pending >= HASH_WORKERS + HASH_QUEUE_SIZE:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'Server busy, try again',
+                            headers={'Retry-After': '1'})
+    if _executor is None:
+        _executor = ProcessPoolExecutor(HASH_WORKERS)
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    return await run_in_pool(_hash, password, BCRYPT_ROUNDS)
+
+
+async def verify_password(password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+    """Returns whether the password matches and, if its cost is outdated, a rehashed replacement"""
+    return await run_in_pool(_verify_and_update, password, password_hash, BCRYPT_ROUNDS)
+
+
+async def start_hash_pool():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(HASH_WORKERS)
+
+
+async def stop_hash_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
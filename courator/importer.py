@@ -0,0 +1,205 @@
+import codecs
+import json
+import os
+import sys
+import time
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from pydantic import ValidationError
+from pymysql import MySQLError, OperationalError
+from syncer import sync
+
+from . import db
+from .conditional import bump_versions, course_entity
+from .queries import upsert_many
+from .schemas import CourseIn, parse_course_code
+
+READ_SIZE = 1 << 20
+INSERT_CHUNK_SIZE = 500
+COURSE_KEY = ('universityID', 'code')
+# Lengths of the Course columns, which accept less than CourseIn does
+MAX_CODE_LENGTH = 16
+MAX_DEPARTMENT_CODE_LENGTH = 8
+
+_decoder = json.JSONDecoder()
+
+
+def iter_json_items(f: BinaryIO, offset: int = 0,
+                    in_array: Optional[bool] = None) -> Iterator[Tuple[object, int, bool]]:
+    """
+    Parse a JSON array or NDJSON file incrementally, yielding each item with the byte offset just past
+    it and whether the file is an array. Parsing resumes from offset when given a previous one
+    """
+    f.seek(offset)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    text = ''
+    pos = 0
+    eof = False
+    while True:
+        if in_array is not False:
+            # Skip separators to reach the next item, or the opening or closing bracket
+            while pos < len(text) and (text[pos].isspace() or (in_array and text[pos] == ',')):
+                offset += len(text[pos].encode())
+                pos += 1
+            if pos < len(text) and in_array is None:
+                in_array = text[pos] == '['
+                if in_array:
+                    offset += 1
+                    pos += 1
+                continue
+            if pos < len(text) and in_array and text[pos] == ']':
+                return
+        if in_array is False:
+            end = text.find('\n', pos)
+            if end != -1 or (eof and pos < len(text)):
+                end = len(text) if end == -1 else end + 1
+                line = text[pos:end]
+                offset += len(line.encode())
+                pos = end
+                if line.strip():
+                    yield json.loads(line), offset, False
+                continue
+        elif pos < len(text):
+            try:
+                item, end = _decoder.raw_decode(text, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                # A number cut off by the end of the buffer, like "1." of "1.5", would parse too early
+                if eof or (end < len(text) and (text[end] in ',]' or text[end].isspace())):
+                    offset += len(text[pos:end].encode())
+                    pos = end
+                    yield item, offset, True
+                    continue
+        if eof:
+            if in_array:
+                raise ValueError('Unterminated JSON array')
+            return
+        chunk = f.read(READ_SIZE)
+        eof = not chunk
+        text = text[pos:] + decoder.decode(chunk, final=eof)
+        pos = 0
+
+
+def course_row(item: object, university_id: int) -> Tuple[dict, Tuple[str, ...]]:
+    """
+    Normalize an item in either the load command's format or the API's into a Course row, along with
+    the fields it supplied, which are the only ones to overwrite on an existing course
+    """
+    if not isinstance(item, dict):
+        raise ValueError('Expected a JSON object')
+    if 'CourseNumber' in item:
+        item = dict(code=item['CourseNumber'], title=item.get('CourseName', ''),
+                    description=item.get('CourseDescription', ''))
+    try:
+        course = CourseIn(**item)
+    except ValidationError as e:
+        raise ValueError(str(e))
+    dep, num = parse_course_code(course.code)
+    if len(dep + num) > MAX_CODE_LENGTH or len(dep) > MAX_DEPARTMENT_CODE_LENGTH:
+        raise ValueError('Course code {} is too long'.format(course.code))
+    row = dict(course.dict(), universityID=university_id, code=dep + num, departmentCode=dep)
+    return row, tuple(sorted(set(course.dict(exclude_unset=True)) - {'code'}))
+
+
+def load_checkpoint(checkpoint_path: str, size: int) -> dict:
+    if not os.path.isfile(checkpoint_path):
+        return dict(offset=0, items=0, imported=0, inArray=None)
+    with open(checkpoint_path) as f:
+        checkpoint = json.load(f)
+    if checkpoint['size'] != size:
+        print('Checkpoint {} is for a different file, delete it to start over'.format(checkpoint_path))
+        raise SystemExit(1)
+    print('Resuming after {} items'.format(checkpoint['items']))
+    return checkpoint
+
+
+def save_checkpoint(checkpoint_path: str, checkpoint: dict):
+    with open(checkpoint_path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+
+def show_progress(checkpoint: dict, size: int, rate: float, final: bool = False):
+    sys.stderr.write('\r{:.1f}% | {} items | {} imported | {:.0f} courses/s{}'.format(
+        100 * checkpoint['offset'] / max(size, 1), checkpoint['items'], checkpoint['imported'], rate,
+        '\n' if final else ''
+    ))
+    sys.stderr.flush()
+
+
+@sync
+async def import_courses(path: str, university_code: str, batch_size: int, checkpoint_path: str = None):
+    """
+    Stream courses from a JSON array or NDJSON file straight into the database, committing batch_size
+    courses per transaction and recording progress in a checkpoint file so an interrupted run can resume
+    """
+    checkpoint_path = checkpoint_path or path + '.checkpoint'
+    size = os.path.getsize(path)
+    checkpoint = load_checkpoint(checkpoint_path, size)
+    checkpoint['size'] = size
+    async with db:
+        row = await db.fetch_one('SELECT id FROM University WHERE code = :code', dict(code=university_code))
+        if not row:
+            print('University not found')
+            raise SystemExit(1)
+        university_id = row[0]
+        start = time.monotonic()
+        imported_before = checkpoint['imported']
+        rows = {}  # type: dict
+
+        def get_rate():
+            return (checkpoint['imported'] - imported_before) / max(time.monotonic() - start, 1e-9)
+
+        async def write_batch():
+            """Write the batch in one transaction, or if it is rejected, one course at a time skipping failures"""
+            groups = {}  # type: dict
+            for row, fields in rows.values():
+                groups.setdefault(fields, []).append(row)
+            imported = len(rows)
+            try:
+                async with db.transaction():
+                    for fields, values in groups.items():
+                        for i in range(0, len(values), INSERT_CHUNK_SIZE):
+                            await db.execute(*upsert_many('Course', values[i:i + INSERT_CHUNK_SIZE], COURSE_KEY,
+                                                          fields))
+            except MySQLError:
+                for row, fields in rows.values():
+                    try:
+                        await db.execute(*upsert_many('Course', [row], COURSE_KEY, fields))
+                    except OperationalError:
+                        raise  # Like a lost connection, which skipping rows wouldn't get past
+                    except MySQLError as e:
+                        sys.stderr.write('\rSkipping course {}: {}\n'.format(row['code'], e.args[-1]))
+                        imported -= 1
+            checkpoint['imported'] += imported
+            rows.clear()
+            save_checkpoint(checkpoint_path, checkpoint)
+            show_progress(checkpoint, size, get_rate())
+
+        with open(path, 'rb') as f:
+            try:
+                for item, offset, in_array in iter_json_items(f, checkpoint['offset'], checkpoint['inArray']):
+                    checkpoint['items'] += 1
+                    try:
+                        course = course_row(item, university_id)
+                    except ValueError as e:
+                        sys.stderr.write('\rSkipping item {}: {}\n'.format(checkpoint['items'], e))
+                    else:
+                        # Later duplicates win, as they would if written in separate statements
+                        rows[course[0]['code']] = course
+                    checkpoint.update(offset=offset, inArray=in_array)
+                    if len(rows) >= batch_size:
+                        await write_batch()
+            except ValueError as e:
+                await write_batch()
+                print('\nInvalid JSON after byte {}: {}'.format(checkpoint['offset'], e))
+                raise SystemExit(1)
+        await write_batch()
+        show_progress(checkpoint, size, get_rate(), final=True)
+        await bump_versions(course_entity(university_code))
+    os.remove(checkpoint_path)
+    print('Imported {} courses. Running servers pick them up for search within their refresh interval'.format(
+        checkpoint['imported']
+    ))
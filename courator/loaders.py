@@ -0,0 +1,110 @@
+import asyncio
+import contextvars
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from . import db
+from .queries import in_clause
+from .replicas import use_replica
+from .schemas import Account, Course, University
+
+MAX_BATCH_SIZE = 500
+
+BatchFunction = Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]]
+
+
+class BatchLoader:
+    """
+    Coalesces lookups made during the same event loop iteration into a single call
+    of batch_fn, which maps a list of keys to a dict of the values that were found
+    """
+
+    def __init__(self, batch_fn: BatchFunction, max_batch_size: int = MAX_BATCH_SIZE):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        # Separate batches for callers that may read from a replica and ones that must see the primary
+        self.pending = {}  # type: Dict[bool, Dict[Hashable, asyncio.Future]]
+
+    async def load(self, key: Hashable) -> Optional[Any]:
+        """The value for key, or None if batch_fn didn't return one"""
+        replica = use_replica.get()
+        pending = self.pending.setdefault(replica, {})
+        future = pending.get(key)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            if not pending:
+                # Run in a fresh context so the batch isn't tied to whichever request came first
+                context = contextvars.Context()
+                context.run(use_replica.set, replica)
+                loop.call_soon(self.dispatch, replica, context=context)
+            future = pending[key] = loop.create_future()
+            future.add_done_callback(_retrieve_exception)
+        # Shielded so one cancelled caller doesn't cancel the lookup for the others
+        return await asyncio.shield(future)
+
+    def dispatch(self, replica: bool):
+        pending = self.pending.pop(replica)
+        keys = list(pending)
+        for i in range(0, len(keys), self.max_batch_size):
+            asyncio.ensure_future(self.run({key: pending[key] for key in keys[i:i + self.max_batch_size]}))
+
+    async def run(self, batch: Dict[Hashable, asyncio.Future]):
+        try:
+            results = await self.batch_fn(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(results.get(key))
+
+
+def _retrieve_exception(future: asyncio.Future):
+    if not future.cancelled():
+        future.exception()  # Callers may all have gone, so mark any error as retrieved
+
+
+async def load_courses(keys: List[Tuple[int, str]]) -> Dict[Tuple[int, str], Course]:
+    """Courses by (universityID, lowercase code)"""
+    fields = list(Course.__fields__)
+    codes = {}  # type: Dict[int, List[str]]
+    for university_id, code in keys:
+        codes.setdefault(university_id, []).append(code)
+    # Grouped by university rather than a row value IN list, which SQLite snapshots don't support
+    conditions = []
+    args = {}
+    for i, (university_id, university_codes) in enumerate(codes.items()):
+        codes_sql, codes_args = in_clause('code{}_'.format(i), university_codes)
+        conditions.append('(universityID = :university{} AND code IN {})'.format(i, codes_sql))
+        args.update(codes_args)
+        args['university{}'.format(i)] = university_id
+    rows = await db.fetch_all(
+        'SELECT {} FROM Course WHERE {}'.format(', '.join(fields), ' OR '.join(conditions)), args
+    )
+    courses = [Course(**dict(zip(fields, row))) for row in rows]
+    return {(course.universityID, course.code.lower()): course for course in courses}
+
+
+async def load_universities(keys: List[str]) -> Dict[str, University]:
+    """Universities by lowercase code"""
+    fields = list(University.__fields__)
+    codes_sql, codes_args = in_clause('code', keys)
+    rows = await db.fetch_all(
+        'SELECT {} FROM University WHERE code IN {}'.format(', '.join(fields), codes_sql), codes_args
+    )
+    universities = [University(**dict(zip(fields, row))) for row in rows]
+    return {university.code.lower(): university for university in universities}
+
+
+async def load_accounts(keys: List[int]) -> Dict[int, Account]:
+    fields = list(Account.__fields__)
+    ids_sql, ids_args = in_clause('id', keys)
+    rows = await db.fetch_all('SELECT {} FROM Account WHERE id IN {}'.format(', '.join(fields), ids_sql), ids_args)
+    accounts = [Account(**dict(zip(fields, row))) for row in rows]
+    return {account.id: account for account in accounts}
+
+
+course_loader = BatchLoader(load_courses)
+university_loader = BatchLoader(load_universities)
+account_loader = BatchLoader(load_accounts)
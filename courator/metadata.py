@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+from asyncio import ensure_future
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+from urllib.parse import urljoin
+
+import httpx
+from bs4 import BeautifulSoup
+from loguru import logger
+from syncer import sync
+
+from . import db, outbound
+from .config import METADATA_MAX_AGE_DAYS, PUBLIC_URL
+from .schemas import CourseMetadata, format_course_code
+
+# Icons are served from our own origin, so only raster images recognized by their leading bytes are kept,
+# never the remote content type, which could be HTML or script-bearing SVG
+ICON_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\x00\x00\x01\x00', 'image/x-icon'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+]
+ICON_TYPES = {content_type for _, content_type in ICON_SIGNATURES} | {'image/webp'}
+MAX_ICON_BYTES = 256 * 1024
+
+_in_flight = {}  # type: Dict[Tuple[int, str], asyncio.Future]
+_generic_icon_hash = None  # type: Optional[str]
+
+
+async def guess_url(query):
+    r = await outbound.get('https://www.google.com/search', params={'btnI': '', 'q': query}, follow_redirects=False)
+    if r.is_redirect and 'location' in r.headers:
+        website = r.headers['location']
+        prefix = 'https://www.google.com/url?q='
+        if website.startswith(prefix):
+            website = website[len(prefix):]
+        return website
+    return ''
+
+
+def sniff_icon_type(data: bytes) -> Optional[str]:
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, content_type in ICON_SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    return None
+
+
+async def store_icon(r: httpx.Response) -> str:
+    """
+    Save icon bytes once per distinct content and return the URL they are served from,
+    or an empty string if the response isn't a successful, reasonably sized image
+    """
+    content_type = sniff_icon_type(r.content)
+    if not r.is_success or len(r.content) > MAX_ICON_BYTES or content_type is None:
+        logger.debug('Not storing icon from {} ({}, {} bytes)', r.url, r.status_code, len(r.content))
+        return ''
+    icon_hash = hashlib.sha256(r.content).hexdigest()
+    await db.execute(
+        'INSERT INTO Icon (hash, contentType, data) VALUES (:hash, :contentType, :data) '
+        'ON DUPLICATE KEY UPDATE hash = hash',
+        dict(hash=icon_hash, contentType=content_type, data=r.content)
+    )
+    return '{}/icon/{}'.format(PUBLIC_URL.rstrip('/'), icon_hash)
+
+
+def guc_icon_favicon_request_args(url: str) -> dict:
+    return dict(url='https://s2.googleusercontent.com/s2/favicons', params={'domain_url': url})
+
+
+async def guc_get_generic_icon_hash() -> str:
+    global _generic_icon_hash
+    if _generic_icon_hash is None:
+        r = await outbound.get(**guc_icon_favicon_request_args('.'))
+        _generic_icon_hash = hashlib.sha256(r.content).hexdigest()
+    return _generic_icon_hash
+
+
+async def get_favicon_url(website) -> str:
+    website_cor = ensure_future(outbound.get(website))
+    guc_cor = ensure_future(outbound.get(**guc_icon_favicon_request_args(website)))
+    bs = BeautifulSoup((await website_cor).text, 'html.parser')
+    link = bs.find("link", rel=lambda x: 'icon' in x.split())
+    if link:
+        icon_url = await store_icon(await outbound.get(urljoin(website, link['href'])))
+        if icon_url:
+            guc_cor.cancel()
+            return icon_url
+    guc_icon = await guc_cor
+    if hashlib.sha256(guc_icon.content).hexdigest() != await guc_get_generic_icon_hash():
+        return await store_icon(guc_icon)
+    return ''
+
+
+async def replace_error(coroutine, error_type, value):
+    try:
+        return await coroutine
+    except error_type as e:
+        logger.debug('Error running coroutine: {}', e)
+        return value
+
+
+async def scrape_course_metadata(university_code: str, course_code: str) -> CourseMetadata:
+    metadata = CourseMetadata()
+    code = format_course_code(course_code)
+    website_cors = [
+        ensure_future(guess_url(fmt.format(univ=university_code, course=code)))
+        for fmt in
+        ['{univ} {course} home page', '{univ} {course} page', '{univ} {course} homepage', '{univ} {course} website']
+    ]
+    info_cor = ensure_future(guess_url('{} course description {}'.format(code, university_code)))
+
+    metadata.catalogUrl = await replace_error(info_cor, httpx.HTTPError, '')
+
+    for website_cor in website_cors:
+        website = await replace_error(website_cor, httpx.HTTPError, '')
+        if website and website != metadata.catalogUrl:
+            metadata.websiteUrl = website
+            break
+    for website_cor in website_cors:
+        website_cor.cancel()
+
+    if metadata.websiteUrl:
+        metadata.iconUrl = await replace_error(get_favicon_url(metadata.websiteUrl), httpx.HTTPError, '')
+    return metadata
+
+
+async def load_course_metadata(university_id: int, course_code: str) -> Optional[Tuple[CourseMetadata, datetime]]:
+    row = await db.fetch_one(
+        'SELECT iconUrl, websiteUrl, catalogUrl, fetchedAt FROM CourseMetadata '
+        'WHERE universityID = :universityID AND courseCode = :courseCode',
+        dict(universityID=university_id, courseCode=course_code)
+    )
+    if not row:
+        return None
+    icon_url, website_url, catalog_url, fetched_at = row
+    return CourseMetadata(iconUrl=icon_url, websiteUrl=website_url, catalogUrl=catalog_url), fetched_at
+
+
+async def store_course_metadata(university_id: int, course_code: str, metadata: CourseMetadata):
+    await db.execute(
+        'INSERT INTO CourseMetadata (universityID, courseCode, iconUrl, websiteUrl, catalogUrl, fetchedAt) '
+        'VALUES (:universityID, :courseCode, :iconUrl, :websiteUrl, :catalogUrl, :fetchedAt) '
+        'ON DUPLICATE KEY UPDATE iconUrl = VALUES(iconUrl), websiteUrl = VALUES(websiteUrl), '
+        'catalogUrl = VALUES(catalogUrl), fetchedAt = VALUES(fetchedAt)',
+        dict(metadata.dict(), universityID=university_id, courseCode=course_code,
+             fetchedAt=datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+    )
+
+
+async def _refresh(university_id: int, university_code: str, course_code: str) -> CourseMetadata:
+    try:
+        metadata = await scrape_course_metadata(university_code, course_code)
+        await store_course_metadata(university_id, course_code, metadata)
+        return metadata
+    finally:
+        del _in_flight[university_id, course_code]
+
+
+def _log_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception():
+        logger.warning('Failed to refresh course metadata: {}', future.exception())
+
+
+def refresh_course_metadata(university_id: int, university_code: str, course_code: str) -> asyncio.Future:
+    """Scrape and store a course's metadata, sharing the work with any refresh already running for it"""
+    key = (university_id, course_code)
+    if key not in _in_flight:
+        _in_flight[key] = ensure_future(_refresh(university_id, university_code, course_code))
+        _in_flight[key].add_done_callback(_log_failure)
+    return _in_flight[key]
+
+
+def is_stale(fetched_at: datetime) -> bool:
+    return datetime.utcnow() - fetched_at > timedelta(days=METADATA_MAX_AGE_DAYS)
+
+
+@sync
+async def prefetch_university_metadata(university_code: str, concurrency: int, force: bool):
+    await outbound.start_http_client()
+    try:
+        async with db:
+            row = await db.fetch_one('SELECT id FROM University WHERE code = :code', dict(code=university_code))
+            if not row:
+                print('University not found')
+                raise SystemExit(1)
+            university_id = row[0]
+            rows = await db.fetch_all(
+                'SELECT c.code, m.fetchedAt FROM Course c '
+                'LEFT JOIN CourseMetadata m ON m.universityID = c.universityID AND m.courseCode = c.code '
+                'WHERE c.universityID = :universityID',
+                dict(universityID=university_id)
+            )
+            codes = [code for code, fetched_at in rows if force or fetched_at is None or is_stale(fetched_at)]
+            print('Fetching metadata for {} of {} courses...'.format(len(codes), len(rows)))
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def prefetch(code):
+                async with semaphore:
+                    try:
+                        await refresh_course_metadata(university_id, university_code, code)
+                    except Exception as e:
+                        print('Failed to fetch {}: {}'.format(code, e))
+                    else:
+                        print('Fetched {}'.format(code))
+
+            await asyncio.gather(*map(prefetch, codes))
+    finally:
+        await outbound.stop_http_client()
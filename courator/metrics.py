@@ -0,0 +1,113 @@
+import re
+import time
+from typing import Iterator, List, Tuple
+
+from prometheus_client import Histogram
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
+
+from .cache import caches
+from .database import InstrumentedDatabase
+
+# Each event is one histogram observation and everything else is read from existing counters when
+# scraped, so metrics are cheap enough to leave on
+REQUEST_DURATION = Histogram(
+    'courator_http_request_duration_seconds', 'Time to handle a request and send its response',
+    ['method', 'route', 'status']
+)
+QUERY_DURATION = Histogram(
+    'courator_db_query_duration_seconds', 'Time to run a database statement, named by verb and table',
+    ['statement'], buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+POOL_ACQUIRE_DURATION = Histogram(
+    'courator_db_pool_acquire_seconds', 'Time waiting for a pooled database connection',
+    ['database'], buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5)
+)
+OUTBOUND_DURATION = Histogram(
+    'courator_outbound_request_duration_seconds', 'Time for an outbound HTTP request, excluding rate limiting',
+    ['host', 'status']
+)
+
+_table_pattern = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+`?(\w+)', re.IGNORECASE)
+
+
+def statement_name(query: str) -> str:
+    """Like "SELECT Course" so statements group without a series per distinct query"""
+    verb = query.split(None, 1)[0].upper() if query.strip() else ''
+    match = _table_pattern.search(query)
+    return '{} {}'.format(verb, match.group(1)) if match else verb
+
+
+def observe_query(query: str, values, duration: float):
+    QUERY_DURATION.labels(statement_name(query)).observe(duration)
+
+
+class MetricsMiddleware:
+    """
+    Times requests by route template. Plain ASGI rather than an http middleware function, which
+    would add a task per request and stop timing when a streamed response starts
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            REQUEST_DURATION.labels(scope['method'], route, str(status)).observe(time.perf_counter() - start)
+
+
+class StatsCollector:
+    """
+    Connection pool and cache figures, read when scraped. Cache hit ratios come from
+    rate(courator_cache_hits_total) / (rate(courator_cache_hits_total) + rate(courator_cache_misses_total))
+    """
+
+    def __init__(self, databases: List[Tuple[str, InstrumentedDatabase]]):
+        self.databases = databases
+
+    def collect(self) -> Iterator:
+        size = GaugeMetricFamily('courator_db_pool_connections', 'Open pooled connections', labels=['database'])
+        in_use = GaugeMetricFamily('courator_db_pool_in_use', 'Pooled connections in use', labels=['database'])
+        limit = GaugeMetricFamily('courator_db_pool_max_connections', 'Pool size limit', labels=['database'])
+        for name, database in self.databases:
+            pool = database.pool
+            if pool is not None:
+                size.add_metric([name], pool.size)
+                in_use.add_metric([name], pool.size - pool.freesize)
+                limit.add_metric([name], pool.maxsize)
+        yield from (size, in_use, limit)
+
+        hits = CounterMetricFamily('courator_cache_hits', 'Cache lookups that found a value', labels=['cache'])
+        misses = CounterMetricFamily('courator_cache_misses', 'Cache lookups that found nothing', labels=['cache'])
+        entries = GaugeMetricFamily('courator_cache_entries', 'Values held in a cache', labels=['cache'])
+        for name, cache in list(caches.items()):
+            hits.add_metric([name], cache.hits)
+            misses.add_metric([name], cache.misses)
+            entries.add_metric([name], len(cache.data))
+        yield from (hits, misses, entries)
+
+
+def setup_metrics(app, db: InstrumentedDatabase):
+    databases = [('primary', db)]
+    databases += [('replica{}'.format(i), replica) for i, replica in enumerate(getattr(db, 'replicas', []))]
+    for name, database in databases:
+        database.acquire_listeners.append(POOL_ACQUIRE_DURATION.labels(name).observe)
+    # Replicas share the primary's query listeners
+    db.listeners.append(observe_query)
+    REGISTRY.register(StatsCollector(databases))
+    app.add_middleware(MetricsMiddleware)
+
@@ -0,0 +1,98 @@
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+from .config import OUTBOUND_TIMEOUT_SECONDS, OUTBOUND_MAX_CONNECTIONS, OUTBOUND_PER_HOST_LIMIT, \
+    OUTBOUND_RATE_PER_SECOND
+from .metrics import OUTBOUND_DURATION
+
+# Hosts timed under their own name. Course websites are grouped so metrics don't grow with them
+METRIC_HOSTS = {'www.google.com', 's2.googleusercontent.com'}
+
+_client = None  # type: Optional[httpx.AsyncClient]
+_host_semaphores = {}  # type: Dict[str, asyncio.Semaphore]
+_in_flight = {}  # type: Dict[Tuple, asyncio.Future]
+
+
+class TokenBucket:
+    """Allows rate acquisitions per second on average with bursts of up to capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+_bucket = TokenBucket(OUTBOUND_RATE_PER_SECOND, max(1.0, OUTBOUND_RATE_PER_SECOND))
+
+
+async def start_http_client():
+    global _client
+    _client = httpx.AsyncClient(
+        timeout=httpx.Timeout(OUTBOUND_TIMEOUT_SECONDS),
+        limits=httpx.Limits(max_connections=OUTBOUND_MAX_CONNECTIONS,
+                            max_keepalive_connections=OUTBOUND_MAX_CONNECTIONS)
+    )
+
+
+async def stop_http_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _get(url: str, params: Optional[dict], follow_redirects: bool) -> httpx.Response:
+    host = urlsplit(url).hostname or ''
+    if host not in _host_semaphores:
+        _host_semaphores[host] = asyncio.Semaphore(OUTBOUND_PER_HOST_LIMIT)
+    async with _host_semaphores[host]:
+        await _bucket.acquire()
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            r = await _client.get(url, params=params, follow_redirects=follow_redirects)
+            status = str(r.status_code)
+            return r
+        except asyncio.CancelledError:
+            status = 'cancelled'
+            raise
+        finally:
+            OUTBOUND_DURATION.labels(host if host in METRIC_HOSTS else 'website', status).observe(
+                time.perf_counter() - start
+            )
+
+
+def _finish(key: Tuple, future: asyncio.Future):
+    del _in_flight[key]
+    if not future.cancelled():
+        future.exception()  # Waiters may all have gone, so mark any error as retrieved
+
+
+async def get(url: str, params: dict = None, follow_redirects: bool = True) -> httpx.Response:
+    """
+    GET through the shared client, rate limited globally and per host. Concurrent
+    requests for the same URL wait on one fetch instead of each making their own
+    """
+    if _client is None:
+        raise RuntimeError('Outbound HTTP client is not started')
+    key = (url, tuple(sorted((params or {}).items())), follow_redirects)
+    if key not in _in_flight:
+        future = asyncio.ensure_future(_get(url, params, follow_redirects))
+        future.add_done_callback(lambda f: _finish(key, f))
+        _in_flight[key] = future
+    return await asyncio.shield(_in_flight[key])
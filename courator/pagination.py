@@ -0,0 +1,55 @@
+import base64
+import json
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, Response
+from fastapi import status
+
+from . import db
+from .cache import TTLCache
+from .config import SNAPSHOT_PATH
+
+COUNT_CACHE_SECONDS = 60
+
+_counts = TTLCache('counts', maxsize=10000, ttl=COUNT_CACHE_SECONDS)
+
+
+def encode_cursor(*values) -> str:
+    """Encode the sort key of the last row of a page as an opaque cursor"""
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode()
+
+
+def decode_cursor(cursor: str, types: Tuple[type, ...]) -> list:
+    """Values of a cursor, checked against the types its sort key should have since they go into queries"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != len(types) or not all(
+        type(value) is value_type for value, value_type in zip(values, types)
+    ):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, 'Invalid cursor')
+    return values
+
+
+async def approximate_count(table: str, where: str = '', args: dict = None) -> int:
+    """
+    Row estimate from the query planner, which unlike COUNT(*) doesn't read every matching row.
+    Snapshots are local and never change, so they count exactly
+    """
+    query = '{} FROM {}'.format('SELECT COUNT(*)' if SNAPSHOT_PATH else 'EXPLAIN SELECT 1', table)
+    query += ' WHERE ' + where if where else ''
+    args = args or {}
+    key = (query, tuple(sorted(args.items())))
+    count = _counts.get(key)
+    if count is None:
+        row = await db.fetch_one(query, args)
+        count = int((row[0] if SNAPSHOT_PATH else row['rows']) or 0)
+        _counts.set(key, count)
+    return count
+
+
+def set_page_headers(response: Response, next_cursor: Optional[str], approximate_total: int):
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    response.headers['X-Approximate-Total-Count'] = str(approximate_total)
@@ -0,0 +1,41 @@
+from typing import List, Tuple, Iterable
+
+
+def values_clause(rows: List[dict], prefix: str = 'v') -> Tuple[str, dict]:
+    """Build a multi-row VALUES list with a uniquely named parameter per cell"""
+    fields = list(rows[0])
+    args = {}
+    groups = []
+    for i, row in enumerate(rows):
+        names = ['{}{}_{}'.format(prefix, i, field) for field in fields]
+        args.update(zip(names, (row[field] for field in fields)))
+        groups.append('({})'.format(', '.join(':' + name for name in names)))
+    return ', '.join(groups), args
+
+
+def insert_many(table: str, rows: List[dict], suffix: str = '') -> Tuple[str, dict]:
+    """Build a single INSERT statement that writes all rows in one round trip"""
+    values, args = values_clause(rows)
+    query = 'INSERT INTO {} ({}) VALUES {}'.format(table, ', '.join(rows[0]), values)
+    if suffix:
+        query += ' ' + suffix
+    return query, args
+
+
+def in_clause(name: str, values: Iterable) -> Tuple[str, dict]:
+    """Build "(:name0, :name1, ...)" for use with IN along with its arguments"""
+    args = {'{}{}'.format(name, i): value for i, value in enumerate(values)}
+    return '({})'.format(', '.join(':' + i for i in args)), args
+
+
+def upsert_many(table: str, rows: List[dict], key_fields: Iterable[str],
+                update_fields: Iterable[str] = None) -> Tuple[str, dict]:
+    """
+    Build a multi-row INSERT that overwrites the non-key fields of rows that already exist, or
+    only update_fields of them if given
+    """
+    key_fields = list(key_fields)
+    updates = [field for field in (rows[0] if update_fields is None else update_fields) if field not in key_fields]
+    return insert_many(table, rows, 'ON DUPLICATE KEY UPDATE {}'.format(', '.join(
+        '{0} = VALUES({0})'.format(field) for field in updates
+    ) or '{0} = {0}'.format(key_fields[0])))
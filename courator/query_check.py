@@ -0,0 +1,84 @@
+from typing import Dict, Optional
+
+import httpx
+from syncer import sync
+
+from . import app, db
+from .autocomplete import rebuild_autocomplete_index
+from .routes import encode_account_token
+from .search import rebuild_search_index
+
+# Requests covering the read routes. Free text filters are left out since they are expected to scan
+SAMPLE_REQUESTS = [
+    '/university',
+    '/university/{universityCode}',
+    '/university/{universityCode}/course',
+    '/university/{universityCode}/course?code={courseCode}',
+    '/university/{universityCode}/course?query={courseCode}',
+    '/university/{universityCode}/course/{courseCode}',
+    '/university/{universityCode}/course/{courseCode}/rating',
+    '/ratingAttribute',
+    '/ratingAttribute?count=3',
+    '/account',
+    '/account/{accountID}/suggestions',
+    '/ratingCorrelation',
+]
+
+
+async def get_sample_values() -> Optional[dict]:
+    row = await db.fetch_one(
+        'SELECT University.code, CourseRating.courseCode, CourseRating.accountID FROM CourseRating '
+        'JOIN University ON University.id = CourseRating.universityID LIMIT 1'
+    )
+    if not row:
+        return None
+    return dict(universityCode=row[0], courseCode=row[1], accountID=row[2])
+
+
+# Starts of queries that read whole tables by design, with the reason
+INTENTIONAL_SCANS = {
+    'SELECT COALESCE(SUM(agg.ratingCount), 0) AS usageCount':
+        'attribute usage sums the aggregates of every course, and there are few attributes',
+}
+
+
+def find_full_scans(query: str, plan: list) -> list:
+    """Tables in a query plan read in full without an index, unless the query is in INTENTIONAL_SCANS"""
+    if ' '.join(query.split()).startswith(tuple(INTENTIONAL_SCANS)):
+        return []
+    return [
+        row['table'] for row in plan
+        if row['type'] == 'ALL' and row['key'] is None and not (row['table'] or '<').startswith('<')
+    ]
+
+
+@sync
+async def check_queries() -> bool:
+    """Run the sample requests, EXPLAIN every SELECT they make and report the ones that scan whole tables"""
+    ok = True
+    recorded = {}  # type: Dict[str, Optional[dict]]
+    async with db:
+        values = await get_sample_values()
+        if not values:
+            print('Database needs at least one course rating to check queries with')
+            return False
+        await rebuild_search_index()
+        await rebuild_autocomplete_index()
+        db.listeners.append(lambda query, args, _: recorded.setdefault(query, args))
+        headers = {'Authorization': 'Bearer {}'.format(encode_account_token(values['accountID']))}
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://check') as client:
+            for path in SAMPLE_REQUESTS:
+                r = await client.get(path.format(**values), headers=headers)
+                if r.status_code >= 500:
+                    print('GET {} failed with {}'.format(path, r.status_code))
+                    ok = False
+        db.listeners.pop()
+        for query, args in recorded.items():
+            if not query.lstrip().upper().startswith('SELECT'):
+                continue
+            tables = find_full_scans(query, await db.fetch_all('EXPLAIN ' + query, args))
+            if tables:
+                print('Full scan of {}: {}'.format(', '.join(tables), ' '.join(query.split())))
+                ok = False
+    print('Checked {} queries'.format(len(recorded)))
+    return ok
@@ -0,0 +1,234 @@
+import asyncio
+import json
+import os
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+from scipy import sparse
+from syncer import sync
+
+from . import db
+from .config import RECOMMENDATIONS_PATH, RECOMMENDATIONS_REFRESH_SECONDS
+from .queries import in_clause
+
+Item = Tuple[int, str]  # (universityID, courseCode)
+
+# Stored ratings are in [0, 1]. Centering them makes a low rating count against similar courses
+RATING_CENTER = 0.5
+FLUSH_THRESHOLD = 10000
+
+overall_ratings_query = (
+    'SELECT cr.id, cr.accountID, cr.universityID, cr.courseCode, crv.value '
+    'FROM CourseRating cr '
+    'INNER JOIN CourseRatingValue crv ON crv.courseRatingID = cr.id '
+    'INNER JOIN CourseRatingAttribute cra ON cra.id = crv.courseRatingAttributeID '
+    'WHERE cra.name = \'_Overall\''
+)
+
+
+class ItemSimilarity:
+    """
+    Item-item cosine similarity over centered overall ratings
+
+    dots[i, j] holds the sum over accounts that rated both courses of the product of their
+    centered ratings and sq_norms[i] the sum of squares of course i, so a new rating only
+    touches the rows of courses the same account already rated. Such increments collect in
+    pending until there are enough of them to be worth merging into the sparse matrix.
+    """
+
+    def __init__(self, items: List[Item], dots: sparse.csr_matrix, sq_norms: np.ndarray, last_rating_id: int):
+        self.items = items
+        self.index = {item: i for i, item in enumerate(items)}
+        self.dots = dots
+        self.sq_norms = np.array(sq_norms, dtype=float)
+        self.last_rating_id = last_rating_id
+        self.pending = defaultdict(lambda: defaultdict(float))  # type: Dict[int, Dict[int, float]]
+        self.pending_count = 0
+
+    @classmethod
+    def build(cls, rows) -> 'ItemSimilarity':
+        """Build from (courseRatingID, accountID, universityID, courseCode, value) rows"""
+        items, accounts = {}, {}
+        user_idx, item_idx, values = [], [], []
+        last_rating_id = 0
+        for rating_id, account_id, university_id, course_code, value in rows:
+            user_idx.append(accounts.setdefault(account_id, len(accounts)))
+            item_idx.append(items.setdefault((university_id, course_code), len(items)))
+            values.append(value - RATING_CENTER)
+            last_rating_id = max(last_rating_id, rating_id)
+        ratings = sparse.csr_matrix((values, (user_idx, item_idx)), shape=(len(accounts), len(items)))
+        dots = (ratings.T @ ratings).tocsr()
+        sq_norms = dots.diagonal()
+        dots.setdiag(0)
+        dots.eliminate_zeros()
+        return cls(list(items), dots, sq_norms, last_rating_id)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.flush()
+        for name in ['data', 'indices', 'indptr']:
+            np.save(os.path.join(path, name + '.npy'), getattr(self.dots, name))
+        np.save(os.path.join(path, 'sq_norms.npy'), self.sq_norms)
+        with open(os.path.join(path, 'items.json'), 'w') as f:
+            json.dump(dict(items=self.items, lastRatingID=self.last_rating_id), f)
+
+    @classmethod
+    def load(cls, path: str) -> 'ItemSimilarity':
+        """Load a saved model, memory-mapping the similarity matrix instead of reading it"""
+        with open(os.path.join(path, 'items.json')) as f:
+            info = json.load(f)
+        items = [tuple(item) for item in info['items']]
+        data, indices, indptr = (
+            np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+            for name in ['data', 'indices', 'indptr']
+        )
+        dots = sparse.csr_matrix((data, indices, indptr), shape=(len(items), len(items)), copy=False)
+        return cls(items, dots, np.load(os.path.join(path, 'sq_norms.npy')), info['lastRatingID'])
+
+    def get_index(self, item: Item) -> int:
+        if item not in self.index:
+            self.index[item] = len(self.items)
+            self.items.append(item)
+            self.sq_norms = np.append(self.sq_norms, 0.0)
+        return self.index[item]
+
+    def add_rating(self, other_ratings: Dict[Item, float], item: Item, value: float):
+        """Fold in a new rating given the ratings the same account made before it"""
+        i = self.get_index(item)
+        centered = value - RATING_CENTER
+        self.sq_norms[i] += centered * centered
+        for other, other_value in other_ratings.items():
+            j = self.get_index(other)
+            if i == j:
+                continue
+            delta = centered * (other_value - RATING_CENTER)
+            self.pending[i][j] += delta
+            self.pending[j][i] += delta
+            self.pending_count += 2
+        if self.pending_count > FLUSH_THRESHOLD:
+            self.flush()
+
+    def flush(self):
+        """Merge pending increments into the sparse matrix, growing it for new courses"""
+        n = len(self.items)
+        rows, cols, deltas = [], [], []
+        for i, row in self.pending.items():
+            for j, delta in row.items():
+                rows.append(i)
+                cols.append(j)
+                deltas.append(delta)
+        old = self.dots
+        indptr = np.concatenate([old.indptr, np.repeat(old.indptr[-1], n - old.shape[0])])
+        grown = sparse.csr_matrix((old.data, old.indices, indptr), shape=(n, n))
+        self.dots = (grown + sparse.csr_matrix((deltas, (rows, cols)), shape=(n, n))).tocsr()
+        self.pending.clear()
+        self.pending_count = 0
+
+    def suggest(self, ratings: Dict[Item, float], count: int) -> List[Item]:
+        """Top courses by similarity-weighted average of the given ratings, excluding rated ones"""
+        rated = [self.index[item] for item in ratings if item in self.index]
+        if not rated:
+            return []
+        n = len(self.items)
+        centered = np.array([ratings[self.items[i]] - RATING_CENTER for i in rated])
+        stored = [(r, i) for r, i in enumerate(rated) if i < self.dots.shape[0]]
+        sub = self.dots[[i for _, i in stored]].tocoo()
+        row_idx = [np.array([r for r, _ in stored], dtype=int)[sub.row]]
+        col_idx, data = [sub.col], [sub.data]
+        for r, i in enumerate(rated):
+            pending = self.pending.get(i, {})
+            row_idx.append(np.full(len(pending), r))
+            col_idx.append(np.fromiter(pending.keys(), dtype=int, count=len(pending)))
+            data.append(np.fromiter(pending.values(), dtype=float, count=len(pending)))
+        rows = sparse.csr_matrix(
+            (np.concatenate(data), (np.concatenate(row_idx), np.concatenate(col_idx))), shape=(len(rated), n)
+        )
+        with np.errstate(divide='ignore'):
+            inv_norms = np.where(self.sq_norms > 0, 1 / np.sqrt(self.sq_norms), 0.0)
+        sims = rows.multiply(inv_norms[rated, None]).multiply(inv_norms[None, :]).tocsr()
+        weights = np.asarray(abs(sims).sum(axis=0)).ravel()
+        scores = np.asarray(sims.T @ centered).ravel()
+        weights[rated] = 0
+        candidates = np.flatnonzero(weights > 0)
+        scores = scores[candidates] / weights[candidates]
+        top = candidates[np.argsort(-scores, kind='stable')[:count]]
+        return [self.items[i] for i in top]
+
+
+model = None  # type: Optional[ItemSimilarity]
+_update_lock = None  # type: Optional[asyncio.Lock]
+_refresh_task = None  # type: Optional[asyncio.Future]
+
+
+async def fetch_account_ratings(account_ids) -> Dict[int, List[Tuple[int, Item, float]]]:
+    ids_sql, ids_args = in_clause('accountID', account_ids)
+    ratings = defaultdict(list)
+    for rating_id, account_id, university_id, course_code, value in await db.fetch_all(
+        overall_ratings_query + ' AND cr.accountID IN ' + ids_sql, ids_args
+    ):
+        ratings[account_id].append((rating_id, (university_id, course_code), value))
+    return ratings
+
+
+async def catch_up():
+    """Fold in every rating submitted since the model last saw one, from any worker"""
+    if model is None:
+        return
+    async with _update_lock:
+        new_rows = await db.fetch_all(
+            overall_ratings_query + ' AND cr.id > :lastID ORDER BY cr.id', dict(lastID=model.last_rating_id)
+        )
+        if not new_rows:
+            return
+        account_ratings = await fetch_account_ratings({row[1] for row in new_rows})
+        for rating_id, account_id, university_id, course_code, value in new_rows:
+            others = {item: v for other_id, item, v in account_ratings[account_id] if other_id < rating_id}
+            model.add_rating(others, (university_id, course_code), value)
+            model.last_rating_id = max(model.last_rating_id, rating_id)
+
+
+async def suggest_courses(account_id: int, count: int) -> List[Item]:
+    if model is None:
+        return []
+    ratings = (await fetch_account_ratings([account_id])).get(account_id, [])
+    return model.suggest({item: value for _, item, value in ratings}, count)
+
+
+async def refresh_loop():
+    while True:
+        await asyncio.sleep(RECOMMENDATIONS_REFRESH_SECONDS)
+        try:
+            await catch_up()
+        except Exception:
+            logger.exception('Failed to update recommendations')
+
+
+async def load_recommendations():
+    global model, _update_lock, _refresh_task
+    _update_lock = asyncio.Lock()
+    if os.path.isdir(RECOMMENDATIONS_PATH):
+        model = ItemSimilarity.load(RECOMMENDATIONS_PATH)
+    else:
+        logger.warning('No recommendation model at "{}", building one in memory. '
+                       'Run "courator build-recommendations" to precompute it.', RECOMMENDATIONS_PATH)
+        model = ItemSimilarity.build(await db.fetch_all(overall_ratings_query))
+    await catch_up()
+    _refresh_task = asyncio.ensure_future(refresh_loop())
+
+
+async def stop_recommendations():
+    if _refresh_task:
+        _refresh_task.cancel()
+
+
+@sync
+async def build_recommendations(path: str):
+    async with db:
+        print('Fetching ratings...')
+        rows = await db.fetch_all(overall_ratings_query)
+    print('Computing similarities of {} ratings...'.format(len(rows)))
+    model = ItemSimilarity.build(rows)
+    model.save(path)
+    print('Saved {} courses with {} similarities to "{}"'.format(len(model.items), model.dots.nnz, path))
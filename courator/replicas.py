@@ -0,0 +1,174 @@
+import asyncio
+import time
+from contextvars import ContextVar
+from typing import List, Optional
+
+from loguru import logger
+from pymysql import MySQLError, OperationalError, ProgrammingError
+from starlette.requests import Request
+
+from .cache import TTLCache
+from .config import REPLICA_CHECK_SECONDS, REPLICA_MAX_LAG_SECONDS, PRIMARY_STICKY_SECONDS
+from .database import InstrumentedDatabase
+
+# Set by route_reads for requests that may read from a replica. Everything else, including
+# writes and maintenance commands, reads from the primary
+use_replica = ContextVar('use_replica', default=False)  # type: ContextVar[bool]
+
+# Clients that wrote recently keep reading from the primary until replicas catch up. Writes set a cookie
+# for browsers and return a header saying until when, which clients that don't keep cookies can send back.
+# Accounts that wrote are also remembered, but only by the worker that took the write
+STICKY_COOKIE = 'courator_primary'
+PRIMARY_UNTIL_HEADER = 'X-Primary-Until'
+MAX_STICKY_ACCOUNTS = 10000
+
+_recent_writers = TTLCache('recent_writers', MAX_STICKY_ACCOUNTS, PRIMARY_STICKY_SECONDS)
+
+
+class ReplicatedDatabase(InstrumentedDatabase):
+    """
+    Primary database that sends reads made while use_replica is set to the least busy replica that is
+    up and not lagging too far behind. Writes and transactions always go to the primary
+    """
+
+    def __init__(self, url, replica_urls: List[str], **options):
+        super().__init__(url, **options)
+        self.replicas = [InstrumentedDatabase(replica_url, **options) for replica_url in replica_urls]
+        for replica in self.replicas:
+            replica.listeners = self.listeners
+        self.healthy = [False] * len(self.replicas)
+        self.checked = [False] * len(self.replicas)
+        self.in_flight = [0] * len(self.replicas)
+        self._turn = 0
+        self._check_task = None  # type: Optional[asyncio.Future]
+
+    def pick_replica(self) -> Optional[int]:
+        if not use_replica.get():
+            return None
+        candidates = [i for i, healthy in enumerate(self.healthy) if healthy]
+        if not candidates:
+            return None
+        # Rotate where ties start so idle replicas share the load
+        self._turn += 1
+        start = self._turn % len(candidates)
+        return min(candidates[start:] + candidates[:start], key=self.in_flight.__getitem__)
+
+    async def read(self, method: str, query, values: dict = None, **kwargs):
+        i = self.pick_replica()
+        if i is not None:
+            self.in_flight[i] += 1
+            try:
+                return await getattr(self.replicas[i], method)(query, values, **kwargs)
+            except (OSError, OperationalError) as e:
+                self.mark_down(i, e)
+            finally:
+                self.in_flight[i] -= 1
+        return await getattr(super(), method)(query, values, **kwargs)
+
+    async def fetch_all(self, query, values: dict = None):
+        return await self.read('fetch_all', query, values)
+
+    async def fetch_one(self, query, values: dict = None):
+        return await self.read('fetch_one', query, values)
+
+    async def fetch_val(self, query, values: dict = None, column=0):
+        return await self.read('fetch_val', query, values, column=column)
+
+    async def iterate(self, query, values: dict = None):
+        i = self.pick_replica()
+        source = super() if i is None else self.replicas[i]
+        async for record in source.iterate(query, values):
+            yield record
+
+    def mark_down(self, i: int, reason):
+        # Logged on the first check too, since replicas start out unused and a bad URL or missing
+        # privilege would otherwise send every read to the primary without a word
+        if self.healthy[i] or not self.checked[i]:
+            logger.warning('Reading from the primary instead of replica {}: {}', i, reason)
+        self.healthy[i] = False
+        self.checked[i] = True
+
+    async def get_lag(self, replica: InstrumentedDatabase) -> Optional[float]:
+        """Seconds the replica is behind, or None if replication has stopped"""
+        try:
+            row = await replica.fetch_one('SHOW REPLICA STATUS')
+        except ProgrammingError:  # Before MySQL 8.0.22
+            row = await replica.fetch_one('SHOW SLAVE STATUS')
+        if row is None:
+            return 0.0  # Not replicating itself, like a managed read replica, so assumed current
+        keys = list(row.keys())
+        lag = row['Seconds_Behind_Source' if 'Seconds_Behind_Source' in keys else 'Seconds_Behind_Master']
+        return None if lag is None else float(lag)
+
+    async def check_replicas(self):
+        for i, replica in enumerate(self.replicas):
+            try:
+                if not replica.is_connected:
+                    await replica.connect()
+                lag = await self.get_lag(replica)
+            except (OSError, MySQLError) as e:
+                self.mark_down(i, e)
+                continue
+            if lag is None or lag > REPLICA_MAX_LAG_SECONDS:
+                self.mark_down(i, 'replication stopped' if lag is None else '{:.0f}s behind'.format(lag))
+            elif not self.healthy[i]:
+                logger.info('Reading from replica {}', i)
+                self.healthy[i] = True
+                self.checked[i] = True
+
+    async def check_loop(self):
+        while True:
+            await asyncio.sleep(REPLICA_CHECK_SECONDS)
+            try:
+                await self.check_replicas()
+            except Exception:
+                logger.exception('Failed to check replicas')
+
+    async def start_replicas(self):
+        await self.check_replicas()
+        self._check_task = asyncio.ensure_future(self.check_loop())
+
+    async def stop_replicas(self):
+        if self._check_task:
+            self._check_task.cancel()
+        for replica in self.replicas:
+            if replica.is_connected:
+                await replica.disconnect()
+
+
+def get_account_id(request: Request) -> Optional[int]:
+    from .routes import decode_account_token  # Imported here since routes needs the database made with this module
+    scheme, _, token = request.headers.get('authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    return decode_account_token(token)
+
+
+def primary_until_requested(request: Request) -> bool:
+    """Whether the request sends back a PRIMARY_UNTIL_HEADER that hasn't passed, ignoring times no write gives"""
+    try:
+        until = float(request.headers.get(PRIMARY_UNTIL_HEADER, ''))
+    except ValueError:
+        return False
+    now = time.time()
+    return now < until <= now + PRIMARY_STICKY_SECONDS
+
+
+async def route_reads(request: Request, call_next):
+    """Middleware letting GET requests read from replicas, unless the client wrote recently"""
+    reads_only = request.method in ('GET', 'HEAD')
+    account_id = get_account_id(request)
+    wrote_recently = STICKY_COOKIE in request.cookies or primary_until_requested(request) or (
+        account_id is not None and _recent_writers.get(account_id) is not None
+    )
+    token = use_replica.set(reads_only and not wrote_recently)
+    try:
+        response = await call_next(request)
+    finally:
+        use_replica.reset(token)
+    if not reads_only and response.status_code < 400:
+        if account_id is not None:
+            _recent_writers.set(account_id, True)
+        response.set_cookie(STICKY_COOKIE, '1', max_age=int(PRIMARY_STICKY_SECONDS), httponly=True, samesite='lax')
+        response.headers[PRIMARY_UNTIL_HEADER] = '{:.3f}'.format(time.time() + PRIMARY_STICKY_SECONDS)
+    return response
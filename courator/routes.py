@@ -1,36 +1,62 @@
-import asyncio
-import base64
-import re
-from asyncio import ensure_future
+import json
+import time
+from asyncio import shield
 from datetime import datetime, timedelta
-from functools import lru_cache
-from typing import Optional, List
-from urllib.parse import urljoin
+from typing import Optional, List, Dict, AsyncIterator, Tuple, Union
 
-import httpx
 import jwt
-from async_lru import alru_cache
-from bs4 import BeautifulSoup
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, BackgroundTasks, Request, Response
 from fastapi import status
 from fastapi.params import Depends
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jwt import PyJWTError
-from loguru import logger
-from passlib.context import CryptContext
-from pydantic import BaseModel
-from pymysql import IntegrityError
-
-from courator import db, DATABASE_URL
-from courator.config import TOKEN_EXPIRATION_DAYS, SECRET_KEY, TOKEN_ALGORITHM
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from pydantic import BaseModel, ValidationError
+from pymysql import IntegrityError, MySQLError
+
+from courator import db, autocomplete
+from courator.aggregates import add_to_aggregates
+from courator.cache import TTLCache, caches
+from courator.conditional import etag_matches, check_not_modified, bump_versions, course_entity, rating_entity, \
+    UNIVERSITY_ENTITY, RATING_ATTRIBUTE_ENTITY
+from courator.config import TOKEN_EXPIRATION_DAYS, SECRET_KEY, TOKEN_ALGORITHM, ACCOUNT_CACHE_SIZE, \
+    ACCOUNT_CACHE_SECONDS, MAX_PAGE_SIZE, FAST_RESPONSES, SNAPSHOT_PATH
+from courator.correlation import get_account_correlations, invalidate_account_correlations
+from courator.export import EXPORTS, MEDIA_TYPES as EXPORT_MEDIA_TYPES, export_lines
+from courator.hashing import hash_password, verify_password
+from courator.loaders import account_loader, course_loader, university_loader
+from courator.metadata import load_course_metadata, refresh_course_metadata, is_stale, ICON_TYPES
+from courator.pagination import encode_cursor, decode_cursor, approximate_count, set_page_headers
+from courator.queries import in_clause, insert_many, upsert_many
+from courator.recommend import suggest_courses, catch_up
+from courator.serialization import compile_mapper, fast_response
+from courator.search import search_courses, index_course, remove_course
+from courator.universities import lookup_university_id, set_university_id, forget_university_code
 from courator.schemas import AccountIn, Account, University, UniversityIn, PERM_ADMIN, Course, CourseIn, CourseUpdateIn, \
-    Token, CourseMetadata, CourseRatingIn, SingleCourseRatingIn, CourseRatingAttribute, CourseRatingAttributeInfo, \
-    RatingAttribute, CourseRatingInfo, RatingAttributeValueInfo, CourseReview, PublicAccount, SingleRatingInfo
+    Token, CourseMetadata, CourseRatingIn, CourseRatingAttribute, CourseRatingAttributeInfo, RatingAttribute, \
+    AutocompleteResult, CacheStats, CourseRatingInfo, RatingAttributeValueInfo, CourseReview, PublicAccount, \
+    SingleRatingInfo, BulkCourseRatingIn, BulkResult, parse_course_code
 
 router = APIRouter()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+MAX_BULK_RATINGS = 1000
+MAX_SEARCH_RESULTS = 100
+DEFAULT_PAGE_SIZE = 50
+BULK_COURSE_CHUNK_SIZE = 500
+COURSE_KEY = ('universityID', 'code')
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonlines')
+
+COURSE_FIELDS = list(Course.__fields__)
+course_mapper = compile_mapper(Course, COURSE_FIELDS)
+# Columns in the order get_ratings selects them
+attribute_rating_mapper = compile_mapper(RatingAttributeValueInfo, ['attributeID', 'count', 'average'])
+rating_value_mapper = compile_mapper(SingleRatingInfo, ['courseRatingID', 'attributeID', 'value'])
+
+account_cache = TTLCache('accounts', ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_SECONDS)
+token_cache = TTLCache('tokens', ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_SECONDS)
 
 credentials_exception = HTTPException(
     status_code=status.HTTP_401_UNAUTHORIZED,
@@ -43,12 +69,18 @@ async def auth_account(token: str = Depends(oauth2_scheme)) -> Account:
     account_id = decode_account_token(token)
     if not account_id:
         raise credentials_exception
-    fields = Account.__fields__
-    query = 'SELECT {} FROM Account WHERE id = :id'.format(', '.join(fields))
-    account_data = await db.fetch_one(query, dict(id=account_id))
-    if not account_data:
-        raise credentials_exception
-    return Account(**dict(zip(fields, account_data)))
+    account = account_cache.get(account_id)
+    if account is None:
+        account = await account_loader.load(account_id)
+        if account is None:
+            raise credentials_exception
+        account_cache.set(account_id, account)
+    return account
+
+
+def invalidate_account(account_id: int):
+    """Call after changing an Account row so other requests stop seeing the cached copy"""
+    account_cache.invalidate(account_id)
 
 
 async def auth_admin_account(token: str = Depends(oauth2_scheme)) -> Account:
@@ -60,7 +92,7 @@ async def auth_admin_account(token: str = Depends(oauth2_scheme)) -> Account:
 
 @router.post('/account', response_model=Account)
 async def account_create(account: AccountIn):
-    password_hash = pwd_context.hash(account.password)
+    password_hash = await hash_password(account.password)
     account_data = dict(**account.dict(exclude={'password'}), passwordHash=password_hash)
     try:
         account_data['id'] = await db.execute(
@@ -84,16 +116,45 @@ async def account_get(account_id: str, account: Account = Depends(auth_account))
     return account
 
 
+@router.get('/cacheStats', response_model=Dict[str, CacheStats])
+async def get_cache_stats(account: Account = Depends(auth_admin_account)):
+    return {name: CacheStats(**cache.stats()) for name, cache in caches.items()}
+
+
+@router.get('/metrics', include_in_schema=False)
+async def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@router.get('/export/{kind}')
+async def export_table(kind: str, fmt: str = Query('ndjson', alias='format', regex='^(ndjson|csv)$'),
+                       account: Account = Depends(auth_admin_account)):
+    """Stream a whole table as NDJSON or CSV"""
+    if kind not in EXPORTS:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'Unknown export, expected one of: ' + ', '.join(EXPORTS))
+    return StreamingResponse(export_lines(kind, fmt), media_type=EXPORT_MEDIA_TYPES[fmt])
+
+
 class Suggestion(BaseModel):
     courseCode: str
     universityCode: str
 
 
 @router.get('/account/{account_id}/suggestions', response_model=List[Suggestion])
-async def account_get(account_id: str, account: Account = Depends(auth_account)):
+async def get_suggestions(account_id: int, count: int = Query(10, ge=1, le=100),
+                          account: Account = Depends(auth_account)):
     if account.id != account_id:
         raise HTTPException(status.HTTP_403_FORBIDDEN, detail='Not authorized for account')
-    return account
+    items = await suggest_courses(account_id, count)
+    if not items:
+        return []
+    ids_sql, ids_args = in_clause('universityID', {university_id for university_id, _ in items})
+    university_codes = dict(await db.fetch_all('SELECT id, code FROM University WHERE id IN ' + ids_sql, ids_args))
+    return [
+        Suggestion(courseCode=course_code, universityCode=university_codes[university_id])
+        for university_id, course_code in items
+        if university_id in university_codes
+    ]
 
 
 def encode_account_token(account_id: int) -> str:
@@ -104,6 +165,12 @@ def encode_account_token(account_id: int) -> str:
 
 
 def decode_account_token(token: str) -> Optional[int]:
+    cached = token_cache.get(token)
+    if cached is not None:
+        account_id, expires = cached
+        if expires > time.time():
+            return account_id
+        token_cache.invalidate(token)
     try:
         payload = jwt.decode(token, str(SECRET_KEY), algorithms=[TOKEN_ALGORITHM])
     except PyJWTError:
@@ -118,9 +185,11 @@ def decode_account_token(token: str) -> Optional[int]:
     if auth_type != 'account':
         return None
     try:
-        return int(auth_value)
+        account_id = int(auth_value)
     except ValueError:
         return None
+    token_cache.set(token, (account_id, payload.get('exp', 0)))
+    return account_id
 
 
 @router.post('/token', response_model=Token)
@@ -129,7 +198,12 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     data = await db.fetch_one(query, dict(email=form_data.username))
     if data:
         account_id, password_hash = data
-        if pwd_context.verify(form_data.password, password_hash):
+        valid, new_hash = await verify_password(form_data.password, password_hash)
+        if valid:
+            if new_hash and not SNAPSHOT_PATH:
+                await db.execute('UPDATE Account SET passwordHash = :passwordHash WHERE id = :id',
+                                 dict(passwordHash=new_hash, id=account_id))
+                invalidate_account(account_id)
             return Token(
                 access_token=encode_account_token(account_id),
                 token_type="bearer"
@@ -150,42 +224,60 @@ def process_query_filters(args: dict, **where):
 
 
 async def get_university_id(university_code: str) -> int:
-    query = 'SELECT id FROM University WHERE code = :code'
-    data = await db.fetch_one(query, dict(code=university_code))
-    if not data:
+    university_id = await lookup_university_id(university_code)
+    if university_id is None:
         raise HTTPException(status.HTTP_404_NOT_FOUND, 'University not found')
-    return data[0]
+    return university_id
 
 
-async def ensure_course_exists(code: str, university_id: int):
-    query = 'SELECT code, universityID FROM Course WHERE code = :code AND universityID = :universityID'
-    if not await db.fetch_one(query, dict(code=code, universityID=university_id)):
+async def ensure_course_exists(code: str, university_id: int) -> str:
+    """The course's code as stored, which may differ in case from the one given"""
+    query = 'SELECT code FROM Course WHERE code = :code AND universityID = :universityID'
+    stored_code = await db.fetch_val(query, dict(code=code, universityID=university_id))
+    if stored_code is None:
         raise HTTPException(status_code=404, detail='Course not found')
+    return stored_code
 
 
 @router.get('/university', response_model=List[University])
-async def get_universities(name: str = '', id: int = None, website: str = ''):
+async def get_universities(request: Request, response: Response, name: str = '', id: int = None, website: str = '',
+                           limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: str = ''):
+    not_modified = await check_not_modified(request, response, UNIVERSITY_ENTITY)
+    if not_modified:
+        return not_modified
     fields = list(University.__fields__)
     args = dict(id=id, name=name, website=website)
-    filters = process_query_filters(args, name='(name LIKE :name OR shortName LIKE :name)')
-    statements = ['SELECT {} FROM University'.format(', '.join(fields))]
-    if filters:
-        statements += ['WHERE ' + ' AND '.join(filters)]
-    query = ' '.join(statements)
-    return [
+    filters = process_query_filters(args, name='(name LIKE :name OR code LIKE :name)')
+    total = await approximate_count('University', ' AND '.join(filters), args)
+    if after:
+        args['afterID'], = decode_cursor(after, (int,))
+        filters.append('id > :afterID')
+    query = 'SELECT {} FROM University {} ORDER BY id LIMIT :limit'.format(
+        ', '.join(fields), 'WHERE ' + ' AND '.join(filters) if filters else ''
+    )
+    universities = [
         University(**dict(zip(fields, row)))
-        for row in await db.fetch_all(query, args)
+        for row in await db.fetch_all(query, dict(args, limit=limit + 1))
     ]
+    next_cursor = None
+    if len(universities) > limit:
+        universities = universities[:limit]
+        next_cursor = encode_cursor(universities[-1].id)
+    set_page_headers(response, next_cursor, total)
+    return universities
 
 
 @router.get('/university/{university_code}', response_model=University)
 async def get_university(university_code: str):
-    fields = list(University.__fields__)
-    query = 'SELECT {} FROM University WHERE code = :code'.format(', '.join(fields))
-    row = await db.fetch_one(query, dict(code=university_code))
-    if not row:
+    university = await university_loader.load(university_code.lower())
+    if university is None:
         raise HTTPException(status.HTTP_404_NOT_FOUND, 'University not found')
-    return University(**dict(zip(fields, row)))
+    return university
+
+
+@router.get('/autocomplete', response_model=List[AutocompleteResult])
+async def get_autocomplete(q: str = '', count: int = Query(10, ge=1, le=50)):
+    return [AutocompleteResult(**result) for result in autocomplete.index.complete(q, count)]
 
 
 @router.post('/university', response_model=University)
@@ -199,6 +291,9 @@ async def create_university(university: UniversityIn, account: Account = Depends
         ),
         data
     )
+    set_university_id(data['code'], data['id'])
+    autocomplete.index.add_university(data['id'], data['code'], data['name'])
+    await bump_versions(UNIVERSITY_ENTITY)
     return University(**data)
 
 
@@ -211,6 +306,9 @@ async def update_university(university: UniversityIn, university_code: str, acco
         )),
         data
     )
+    set_university_id(data['code'], data['id'])
+    autocomplete.index.add_university(data['id'], data['code'], data['name'])
+    await bump_versions(UNIVERSITY_ENTITY)
     return University(**data)
 
 
@@ -222,35 +320,80 @@ async def delete_university(university_code: str, account: Account = Depends(aut
     )
     if deleted != 1:
         raise HTTPException(status.HTTP_404_NOT_FOUND, 'University not found')
+    forget_university_code(university_code)
+    autocomplete.index.remove_university_code(university_code)
+    await bump_versions(UNIVERSITY_ENTITY)
     return {}
 
 
-@router.get('/university/{university_code}/course', response_model=List[Course])
-async def get_courses(university_code: str, code: str = '', title: str = '', description: str = '', query: str = ''):
-    fields = list(Course.__fields__)
-    args = dict(
-        code=code, title=title, description=description,
-        query='%{}%'.format(query) * bool(query), universityID=await get_university_id(university_code)
-    )
-    filters = process_query_filters(
-        args, query='(code LIKE :query OR title LIKE :query)'
-    )
-    query = 'SELECT {} FROM Course ' \
-            'WHERE {}'.format(', '.join(fields), ' AND '.join(filters))
-    return [
-        Course(**dict(zip(fields, row)))
-        for row in await db.fetch_all(query, args)
-    ]
+def course_list(rows: list, response: Response, fast: bool = FAST_RESPONSES):
+    """Courses from rows of COURSE_FIELDS, skipping pydantic entirely when fast"""
+    if fast:
+        return fast_response([course_mapper(row) for row in rows], response)
+    return [Course(**dict(zip(COURSE_FIELDS, row))) for row in rows]
 
 
-def parse_course_code(course_code):
-    m = re.match(r'([A-Za-z]+) *([0-9]+)', course_code)
-    assert m
-    return m.group(1).upper(), m.group(2)
-
-
-def format_course_code(course_code):
-    return '{} {}'.format(*parse_course_code(course_code))
+@router.get('/university/{university_code}/course', response_model=List[Course])
+async def get_courses(request: Request, response: Response, university_code: str, code: str = '', title: str = '',
+                      description: str = '', query: str = '',
+                      limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: str = ''):
+    """
+    Courses in code order, or best match first for a search query. Either way the cursor in
+    X-Next-Cursor continues from the last course returned
+    """
+    not_modified = await check_not_modified(request, response, UNIVERSITY_ENTITY, course_entity(university_code))
+    if not_modified:
+        return not_modified
+    fields = COURSE_FIELDS
+    code_index = fields.index('code')
+    university_id = await get_university_id(university_code)
+    args = dict(code=code, title=title, description=description, universityID=university_id)
+    filters = process_query_filters(args)
+    if query:
+        # Search results are ranked in memory, so they are paged by position in the ranking
+        ranked = search_courses(university_id, query, MAX_SEARCH_RESULTS)
+        if len(filters) > 1 and ranked:
+            # Filter before paging so pages are full and the total counts only matching courses
+            codes_sql, codes_args = in_clause('rankedCode', ranked)
+            matching = {row[0].upper() for row in await db.fetch_all(
+                'SELECT code FROM Course WHERE {} AND code IN {}'.format(' AND '.join(filters), codes_sql),
+                dict(args, **codes_args)
+            )}
+            ranked = [course_code for course_code in ranked if course_code.upper() in matching]
+        start = 0
+        if after:
+            start, = decode_cursor(after, (int,))
+            if start < 0:
+                raise HTTPException(status.HTTP_400_BAD_REQUEST, 'Invalid cursor')
+        page = ranked[start:start + limit]
+        if not page:
+            set_page_headers(response, None, len(ranked))
+            return []
+        codes_sql, codes_args = in_clause('rankedCode', page)
+        filters.append('code IN ' + codes_sql)
+        args.update(codes_args)
+        # Codes compare case-insensitively, so rows may not match the indexed spelling exactly
+        rank = {course_code.upper(): i for i, course_code in enumerate(page)}
+        rows = sorted(await db.fetch_all(
+            'SELECT {} FROM Course WHERE {}'.format(', '.join(fields), ' AND '.join(filters)), args
+        ), key=lambda row: rank.get(row[code_index].upper(), len(page)))
+        next_start = start + len(page)
+        set_page_headers(response, encode_cursor(next_start) if next_start < len(ranked) else None, len(ranked))
+        return course_list(rows, response)
+    total = await approximate_count('Course', ' AND '.join(filters), args)
+    if after:
+        args['afterCode'], = decode_cursor(after, (str,))
+        filters.append('code > :afterCode')
+    sql_query = 'SELECT {} FROM Course WHERE {} ORDER BY code LIMIT :limit'.format(
+        ', '.join(fields), ' AND '.join(filters)
+    )
+    rows = await db.fetch_all(sql_query, dict(args, limit=limit + 1))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][code_index])
+    set_page_headers(response, next_cursor, total)
+    return course_list(rows, response)
 
 
 @router.post('/university/{university_code}/course', response_model=Course)
@@ -266,6 +409,9 @@ async def create_course(course: CourseIn, university_code: str, account: Account
         ),
         data
     )
+    index_course(data['universityID'], data['code'], data['title'], data['description'])
+    autocomplete.index.add_course(data['universityID'], data['code'], data['title'])
+    await bump_versions(course_entity(university_code))
     return Course(**data)
 
 
@@ -274,228 +420,393 @@ async def update_course(course: CourseUpdateIn, university_code: str, course_cod
                         account: Account = Depends(auth_account)):
     fields = course.__fields__
     data = dict(course.dict(), universityID=await get_university_id(university_code), code=course_code)
-    await ensure_course_exists(data['code'], data['universityID'])
     await db.execute(
         'UPDATE Course SET {} WHERE code = :code AND universityID = :universityID'.format(', '.join(
             '{0} = :{0}'.format(i) for i in fields
         )),
         data
     )
+    # The indexes are keyed by the stored code, not however the path spells it
+    data['code'] = await ensure_course_exists(course_code, data['universityID'])
+    index_course(data['universityID'], data['code'], data['title'], data['description'])
+    autocomplete.index.add_course(data['universityID'], data['code'], data['title'])
+    await bump_versions(course_entity(university_code))
     return Course(**data)
 
 
 @router.delete('/university/{university_code}/course/{course_code}', response_model={})
 async def delete_course(university_code: str, course_code: str, account: Account = Depends(auth_account)):
-    data = dict(universityID=await get_university_id(university_code), code=course_code)
-    await ensure_course_exists(data['code'], data['universityID'])
-    await db.execute(
+    university_id = await get_university_id(university_code)
+    # Looked up first so the indexes drop the stored code rather than the path's spelling of it
+    data = dict(universityID=university_id, code=await ensure_course_exists(course_code, university_id))
+    deleted = await db.execute(
         'DELETE FROM Course WHERE code = :code AND universityID = :universityID',
         data
     )
+    if not deleted:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'Course not found')
+    remove_course(data['universityID'], data['code'])
+    autocomplete.index.remove_course(data['universityID'], data['code'])
+    await bump_versions(course_entity(university_code))
     return {}
 
 
-async def get_course(university_code: str, course_code: str):
-    fields = list(Course.__fields__)
-    args = dict(code=course_code, universityID=await get_university_id(university_code))
-    query = 'SELECT {} FROM Course WHERE universityID = :universityID AND code = :code'.format(', '.join(fields))
-    row = await db.fetch_one(query, args)
-    if not row:
+async def read_bulk_items(request: Request) -> AsyncIterator[Union[dict, HTTPException]]:
+    """Items of a JSON array body, or of an NDJSON body as it streams in, with errors for unparsable lines"""
+    if request.headers.get('content-type', '').split(';')[0].strip() not in NDJSON_TYPES:
+        try:
+            items = json.loads(await request.body())
+        except ValueError:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, 'Invalid JSON')
+        if not isinstance(items, list):
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, 'Expected a JSON array')
+        for item in items:
+            yield item
+        return
+    buffer = b''
+    async for chunk in request.stream():
+        *lines, buffer = (buffer + chunk).split(b'\n')
+        for line in lines:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield HTTPException(status.HTTP_400_BAD_REQUEST, 'Invalid JSON')
+    if buffer.strip():
+        try:
+            yield json.loads(buffer)
+        except ValueError:
+            yield HTTPException(status.HTTP_400_BAD_REQUEST, 'Invalid JSON')
+
+
+async def upsert_courses(rows: Dict[int, Tuple[dict, Tuple[str, ...]]], results: List[BulkResult]):
+    """
+    Write a chunk of courses, keyed by their position in results, in a statement per set of fields
+    the items supplied, which are the only ones overwritten on existing courses. If the chunk is
+    rejected, write its courses one at a time to report which ones failed
+    """
+    groups = {}  # type: Dict[Tuple[str, ...], List[dict]]
+    for row, fields in rows.values():
+        groups.setdefault(fields, []).append(row)
+    written = [row for row, _ in rows.values()]
+    try:
+        for fields, group in groups.items():
+            await db.execute(*upsert_many('Course', group, COURSE_KEY, fields))
+    except MySQLError:
+        written = []
+        for i, (row, fields) in rows.items():
+            try:
+                await db.execute(*upsert_many('Course', [row], COURSE_KEY, fields))
+            except MySQLError as e:
+                results[i] = BulkResult(status=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e.args[-1]))
+            else:
+                written.append(row)
+    if not written:
+        return
+    # Existing courses keep the title and description of items that left them out
+    codes_sql, codes_args = in_clause('code', (row['code'] for row in written))
+    for university_id, code, title, description in await db.fetch_all(
+        'SELECT universityID, code, title, description FROM Course '
+        'WHERE universityID = :universityID AND code IN ' + codes_sql,
+        dict(codes_args, universityID=written[0]['universityID'])
+    ):
+        index_course(university_id, code, title, description)
+        autocomplete.index.add_course(university_id, code, title)
+
+
+@router.post('/university/{university_code}/course:bulk', response_model=List[BulkResult])
+async def upsert_courses_bulk(university_code: str, request: Request, account: Account = Depends(auth_account)):
+    """Create or update many courses from a JSON array or an NDJSON stream, with a result per item"""
+    university_id = await get_university_id(university_code)
+    results = []
+    rows = {}
+    async for item in read_bulk_items(request):
+        try:
+            if isinstance(item, HTTPException):
+                raise item
+            if not isinstance(item, dict):
+                raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, 'Expected a JSON object')
+            try:
+                course = CourseIn(**item)
+            except ValidationError as e:
+                raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(e))
+        except HTTPException as e:
+            results.append(BulkResult(status=e.status_code, detail=e.detail))
+            continue
+        dep, num = parse_course_code(course.code)
+        row = dict(course.dict(), universityID=university_id, code=dep + num, departmentCode=dep)
+        rows[len(results)] = (row, tuple(sorted(set(course.dict(exclude_unset=True)) - {'code'})))
+        results.append(BulkResult(status=status.HTTP_200_OK))
+        if len(rows) >= BULK_COURSE_CHUNK_SIZE:
+            await upsert_courses(rows, results)
+            rows = {}
+    if rows:
+        await upsert_courses(rows, results)
+    await bump_versions(course_entity(university_code))
+    return results
+
+
+async def get_course(university_code: str, course_code: str) -> Course:
+    course = await course_loader.load((await get_university_id(university_code), course_code.lower()))
+    if course is None:
         raise HTTPException(status.HTTP_404_NOT_FOUND, 'Course not found')
-    return Course(**dict(zip(fields, row)))
+    return course
 
 
 @router.get('/university/{university_code}/course/{course_code}', response_model=Course)
-async def get_course_route(university_code: str, course_code: str):
+async def get_course_route(request: Request, response: Response, university_code: str, course_code: str):
+    not_modified = await check_not_modified(request, response, UNIVERSITY_ENTITY, course_entity(university_code))
+    if not_modified:
+        return not_modified
     return await get_course(university_code, course_code)
 
 
-async def guess_url(query, client: httpx.AsyncClient):
-    r = await client.get('https://www.google.com/search?btnI=&q=', params={'btnI': '', 'q': query},
-                         allow_redirects=False)
-    if r.is_redirect and 'location' in r.headers:
-        website = r.headers['location']
-        prefix = 'https://www.google.com/url?q='
-        if website.startswith(prefix):
-            website = website[len(prefix):]
-        return website
-    return ''
-
-
-def generate_data_url(r):
-    content_type = r.headers["content-type"]
-    data_string = base64.b64encode(r.content).decode()
-    data_url = "data:{};base64,{}".format(content_type, data_string)
-    return data_url
-
-
-def guc_icon_favicon_request_args(url: str) -> dict:
-    return dict(url='https://s2.googleusercontent.com/s2/favicons', params={'domain_url': url})
-
-
-@lru_cache(1)
-def guc_get_generic_icon_data() -> str:
-    return generate_data_url(httpx.get(**guc_icon_favicon_request_args('.')))
-
-
-async def get_favicon_data(website, client) -> str:
-    website_cor = client.get(website)
-    guc_cor = asyncio.ensure_future(client.get(**guc_icon_favicon_request_args(website)))
-    bs = BeautifulSoup((await website_cor).text, 'html.parser')
-    link = bs.find("link", rel=lambda x: 'icon' in x.split())
-    if link:
-        guc_cor.cancel()
-        return generate_data_url(await client.get(urljoin(website, link['href'])))
-    guc_icon_url = generate_data_url(await guc_cor)
-    if guc_icon_url != guc_get_generic_icon_data():
-        return guc_icon_url
-    return ''
-
-
-async def replace_error(coroutine, error_type, value):
-    try:
-        return await coroutine
-    except error_type as e:
-        logger.debug('Error running coroutine: {}', e)
-        return value
-
-
 @router.get('/university/{university_code}/course/{course_code}/metadata', response_model=CourseMetadata)
-@alru_cache(maxsize=30)
 async def get_course_metadata(university_code: str, course_code: str):
-    course_cor = ensure_future(db.fetch_one(
-        'SELECT 1 FROM Course c JOIN University u ON c.universityID = u.id WHERE u.code = :ucode AND c.code = :ccode',
-        dict(ucode=university_code, ccode=course_code)))
-    metadata = CourseMetadata()
-    async with httpx.AsyncClient() as client:
-        code = format_course_code(course_code)
-        website_cors = [
-            ensure_future(guess_url(fmt.format(univ=university_code, course=code), client))
-            for fmt in
-            ['{univ} {course} home page', '{univ} {course} page', '{univ} {course} homepage', '{univ} {course} website']
-        ]
-        info_cor = ensure_future(guess_url('{} course description {}'.format(code, university_code), client))
-
-        metadata.catalogUrl = await replace_error(info_cor, httpx.HTTPError, '')
-
-        for website_cor in website_cors:
-            website = await replace_error(website_cor, httpx.HTTPError, '')
-            if website and website != metadata.catalogUrl:
-                metadata.websiteUrl = website
-                break
-
-        if metadata.websiteUrl:
-            metadata.iconUrl = await replace_error(get_favicon_data(website, client), httpx.HTTPError, '')
-
-    if not await course_cor:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, 'No such course/university')
-
+    course = await get_course(university_code, course_code)
+    stored = await load_course_metadata(course.universityID, course.code)
+    if SNAPSHOT_PATH:
+        return stored[0] if stored else CourseMetadata()
+    if not stored:
+        return await shield(refresh_course_metadata(course.universityID, university_code, course.code))
+    metadata, fetched_at = stored
+    if is_stale(fetched_at):
+        refresh_course_metadata(course.universityID, university_code, course.code)
     return metadata
 
 
-@router.post('/university/{university_code}/course/{course_code}/rating', response_model={})
-async def submit_rating(university_code: str, course_code: str, course_rating: CourseRatingIn,
-                        account: Account = Depends(auth_account)):
-    id_to_dbid = {}
-    course = await get_course(university_code, course_code)
-    if await db.fetch_one('SELECT * FROM CourseRating WHERE accountID = :accountID AND courseCode = :courseCode AND universityID = :universityID', dict(accountID=account.id, courseCode=course_code, universityID=course.universityID)):
+@router.get('/icon/{icon_hash}')
+async def get_icon(icon_hash: str, request: Request):
+    # Icons are addressed by the hash of their content so they can be cached forever. They come from
+    # other sites, so browsers are told not to reinterpret or run anything in them
+    headers = {
+        'Cache-Control': 'public, max-age=31536000, immutable', 'ETag': '"{}"'.format(icon_hash),
+        'X-Content-Type-Options': 'nosniff', 'Content-Security-Policy': "default-src 'none'"
+    }
+    if etag_matches(request.headers.get('if-none-match', ''), headers['ETag']):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    row = await db.fetch_one('SELECT contentType, data FROM Icon WHERE hash = :hash', dict(hash=icon_hash))
+    # Rows stored before icons were checked may hold any content
+    if not row or row[0] not in ICON_TYPES:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'Icon not found')
+    content_type, data = row
+    return Response(content=data, media_type=content_type, headers=headers)
+
+
+async def get_overall_attribute_id() -> int:
+    r = await db.fetch_one('SELECT id FROM CourseRatingAttribute WHERE name = :name', dict(name='_Overall'))
+    if r:
+        return r[0]
+    return await db.execute(
+        'INSERT INTO CourseRatingAttribute(name, description) VALUES (:name, :description)',
+        dict(name='_Overall', description='Overall course rating')
+    )
+
+
+async def insert_course_rating(course: Course, course_rating: CourseRatingIn, account: Account):
+    """Write a rating with its values and aggregates. Must be called inside a transaction"""
+    if await db.fetch_one(
+        'SELECT 1 FROM CourseRating '
+        'WHERE accountID = :accountID AND courseCode = :courseCode AND universityID = :universityID',
+        dict(accountID=account.id, courseCode=course.code, universityID=course.universityID)
+    ):
         raise HTTPException(status.HTTP_409_CONFLICT, 'Already rated class')
+
+    # New attributes are few, and inserting them one at a time gives each its own id. A multi-row
+    # INSERT's ids needn't be consecutive, such as with auto_increment_increment > 1
+    id_to_dbid = {}
     for new_attr in course_rating.newRatingAttributes:
-        new_id = await db.execute(
+        id_to_dbid[new_attr.id] = await db.execute(
             'INSERT INTO CourseRatingAttribute(name, description) VALUES (:name, :description)',
             dict(name=new_attr.name, description=new_attr.description)
         )
-        id_to_dbid[new_attr.id] = new_id
-    r = await db.fetch_one('SELECT id FROM CourseRatingAttribute WHERE name = :name', dict(name='_Overall'))
-    if not r:
-        overall_id = await db.execute(
-            'INSERT INTO CourseRatingAttribute(name, description) VALUES (:name, :description)',
-            dict(name='.overall', description='Overall course rating')
-        )
-    else:
-        overall_id = r[0]
-    date_str = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+    values = []
+    existing_ids = set()
+    for rating in course_rating.ratings:
+        real_id = id_to_dbid.get(rating.id)
+        if not real_id:
+            try:
+                real_id = int(rating.id)
+            except ValueError:
+                raise HTTPException(status.HTTP_400_BAD_REQUEST, detail='Invalid rating id')
+            existing_ids.add(real_id)
+        values.append((real_id, rating.value / 5.0))
+    if existing_ids:
+        ids_sql, ids_args = in_clause('attributeID', existing_ids)
+        rows = await db.fetch_all('SELECT id FROM CourseRatingAttribute WHERE id IN ' + ids_sql, ids_args)
+        if len(rows) != len(existing_ids):
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, detail='Invalid rating id')
+    values.append((await get_overall_attribute_id(), course_rating.overallRating / 5.0))
+
     rating_id = await db.execute(
         'INSERT INTO CourseRating(description, date, accountID, courseCode, universityID) VALUES '
         '(:description, :date, :accountID, :courseCode, :universityID)',
         dict(
-            description=course_rating.description, date=date_str, accountID=account.id, courseCode=course.code,
-            universityID=course.universityID
+            description=course_rating.description, date=datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+            accountID=account.id, courseCode=course.code, universityID=course.universityID
         )
     )
-    try:
-        for rating in course_rating.ratings + [
-            SingleCourseRatingIn(id=str(overall_id), value=course_rating.overallRating)
-        ]:
-            real_id = id_to_dbid.get(rating.id)
-            if not real_id:
-                real_id = int(rating.id)
-            await db.execute(
-                'INSERT INTO CourseRatingValue(courseRatingID, courseRatingAttributeID, value) VALUES '
-                '(:ratingID, :attributeID, :value)',
-                dict(
-                    ratingID=rating_id, attributeID=real_id, value=rating.value / 5.0
-                )
-            )
-    except (ValueError, IntegrityError):
-        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail='Invalid rating id')
+    await db.execute(*insert_many('CourseRatingValue', [
+        dict(courseRatingID=rating_id, courseRatingAttributeID=attribute_id, value=value)
+        for attribute_id, value in values
+    ]))
+    await add_to_aggregates(course.universityID, course.code, values)
+
 
+@router.post('/university/{university_code}/course/{course_code}/rating', response_model={})
+async def submit_rating(university_code: str, course_code: str, course_rating: CourseRatingIn,
+                        background_tasks: BackgroundTasks, account: Account = Depends(auth_account)):
+    course = await get_course(university_code, course_code)
+    async with db.transaction():
+        await insert_course_rating(course, course_rating, account)
+    await bump_versions(rating_entity(university_code, course_code), RATING_ATTRIBUTE_ENTITY)
+    invalidate_account_correlations(account.id)
+    background_tasks.add_task(catch_up)
     return {}
 
 
+@router.post('/ratings:bulk', response_model=List[BulkResult])
+async def submit_ratings_bulk(course_ratings: List[BulkCourseRatingIn], background_tasks: BackgroundTasks,
+                              account: Account = Depends(auth_account)):
+    if len(course_ratings) > MAX_BULK_RATINGS:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            'At most {} ratings per request'.format(MAX_BULK_RATINGS))
+    results = []
+    changed = []
+    async with db.transaction():
+        for course_rating in course_ratings:
+            try:
+                async with db.transaction():
+                    course = await get_course(course_rating.universityCode, course_rating.courseCode)
+                    await insert_course_rating(course, course_rating, account)
+            except HTTPException as e:
+                results.append(BulkResult(status=e.status_code, detail=e.detail))
+            except MySQLError as e:
+                results.append(BulkResult(status=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e.args[-1])))
+            else:
+                results.append(BulkResult(status=status.HTTP_200_OK))
+                changed.append(rating_entity(course_rating.universityCode, course_rating.courseCode))
+    await bump_versions(RATING_ATTRIBUTE_ENTITY, *changed)
+    invalidate_account_correlations(account.id)
+    background_tasks.add_task(catch_up)
+    return results
+
+
 @router.get('/university/{university_code}/course/{course_code}/rating', response_model=CourseRatingInfo)
-async def get_ratings(university_code: str, course_code: str):
+async def get_ratings(request: Request, response: Response, university_code: str, course_code: str,
+                      limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE), after: str = ''):
+    not_modified = await check_not_modified(
+        request, response, UNIVERSITY_ENTITY, course_entity(university_code), rating_entity(university_code, course_code)
+    )
+    if not_modified:
+        return not_modified
     course = await get_course(university_code, course_code)
     attribute_ratings = await db.fetch_all(
-        'SELECT attributeID, attributeCount, avgRating '
-        'FROM (' + (
-            'SELECT crv.courseRatingAttributeID AS attributeID, COUNT(crv.value) AS attributeCount, AVG(crv.value) AS avgRating '
-            'FROM CourseRatingValue crv '
-            'INNER JOIN CourseRating cr ON cr.id = crv.courseRatingID '
-            'WHERE cr.courseCode = :courseCode AND cr.universityID = :universityID '
-            'GROUP BY crv.courseRatingAttributeID'
-        ) + ') s ' +
-        'ORDER BY attributeCount',
+        'SELECT attributeID, ratingCount, valueSum / ratingCount '
+        'FROM CourseRatingAggregate '
+        'WHERE courseCode = :courseCode AND universityID = :universityID '
+        'ORDER BY ratingCount',
         dict(courseCode=course.code, universityID=course.universityID)
     )
+    args = dict(courseCode=course.code, universityID=course.universityID, limit=limit + 1)
+    keyset = ''
+    if after:
+        args['afterDate'], args['afterID'] = decode_cursor(after, (str, int))
+        keyset = 'AND (cr.date > :afterDate OR (cr.date = :afterDate AND cr.id > :afterID)) '
     reviews = await db.fetch_all(
-        'SELECT a.name AS accountName, a.email AS accountEmail, a.about AS accountAbout, '
-        '   a.id AS accountID, cr.description AS description, cr.date AS date, '
-        '   GROUP_CONCAT(crv.value SEPARATOR \',\') AS ratings, '
-        '    GROUP_CONCAT(cra.id SEPARATOR \',\') AS ratingIDs '
+        'SELECT cr.id, a.name, a.email, a.about, a.id, cr.description, cr.date '
         'FROM CourseRating cr '
         'INNER JOIN Account a ON a.id = cr.accountID '
-        'INNER JOIN CourseRatingValue crv ON crv.courseRatingID = cr.id '
-        'INNER JOIN CourseRatingAttribute cra ON cra.id = crv.courseRatingAttributeID '
-        'WHERE cr.courseCode = :courseCode AND cr.universityID = :universityID '
-        'GROUP BY cr.id '
-        'ORDER BY cr.date',
-        dict(courseCode=course_code, universityID=course.universityID)
+        'WHERE cr.courseCode = :courseCode AND cr.universityID = :universityID ' + keyset +
+        'ORDER BY cr.date, cr.id '
+        'LIMIT :limit',
+        args
     )
+    next_cursor = None
+    if len(reviews) > limit:
+        reviews = reviews[:limit]
+        last_id, *_, last_date = reviews[-1]
+        next_cursor = encode_cursor(last_date.strftime('%Y-%m-%d %H:%M:%S'), last_id)
+    set_page_headers(response, next_cursor, await approximate_count(
+        'CourseRating', 'universityID = :universityID AND courseCode = :courseCode',
+        dict(universityID=course.universityID, courseCode=course.code)
+    ))
+
+    values = []
+    if reviews:
+        ids_sql, ids_args = in_clause('ratingID', (row[0] for row in reviews))
+        values = await db.fetch_all(
+            'SELECT courseRatingID, courseRatingAttributeID, value '
+            'FROM CourseRatingValue '
+            'WHERE courseRatingID IN ' + ids_sql,
+            ids_args
+        )
+    return course_rating_info(attribute_ratings, reviews, values, next_cursor, response)
+
+
+def course_rating_info(attribute_ratings: list, reviews: list, values: list, next_cursor: Optional[str],
+                       response: Response, fast: bool = FAST_RESPONSES):
+    """CourseRatingInfo from the rows queried by get_ratings, skipping pydantic entirely when fast"""
+    ratings = {}
+    if fast:
+        for value_row in values:
+            ratings.setdefault(value_row[0], []).append(rating_value_mapper(value_row))
+        return fast_response(dict(
+            attributes=[attribute_rating_mapper(row) for row in attribute_ratings],
+            reviews=[
+                dict(
+                    account=dict(name=account_name, email=account_email, about=account_about, id=account_id),
+                    description=description, date=int(date.timestamp()), ratings=ratings.get(rating_id, [])
+                )
+                for rating_id, account_name, account_email, account_about, account_id, description, date in reviews
+            ],
+            nextCursor=next_cursor
+        ), response)
+
+    for rating_id, attribute_id, value in values:
+        ratings.setdefault(rating_id, []).append(SingleRatingInfo(value=value, attributeID=attribute_id))
     return CourseRatingInfo(
         attributes=[
             RatingAttributeValueInfo(attributeID=attribute_id, average=avg_rating, count=attribute_count)
             for attribute_id, attribute_count, avg_rating in attribute_ratings
         ],
         reviews=[
-            CourseReview(account=PublicAccount(name=accountName, id=accountID, email=accountEmail, about=accountAbout), description=description, date=date.timestamp(), ratings=[
-                SingleRatingInfo(value=float(val), attributeID=int(ratingID))
-                for val, ratingID in zip(ratings.split(','), ratingIDs.split(','))
-            ])
-            for accountName, accountEmail, accountAbout, accountID, description, date, ratings, ratingIDs in reviews
-            if accountName is not None
-        ]
+            CourseReview(
+                account=PublicAccount(name=account_name, id=account_id, email=account_email, about=account_about),
+                description=description, date=date.timestamp(), ratings=ratings.get(rating_id, [])
+            )
+            for rating_id, account_name, account_email, account_about, account_id, description, date in reviews
+        ],
+        nextCursor=next_cursor
     )
 
 
 @router.get('/ratingAttribute', response_model=List[CourseRatingAttribute])
-async def get_rating_attributes(count: Optional[int] = None):
-    rows = await db.fetch_all('SELECT SUM(1) AS attributeCount, cra.id, name, description '
-                              'FROM CourseRatingValue crv '
-                              'RIGHT JOIN CourseRatingAttribute cra ON cra.id = crv.courseRatingAttributeID '
-                              'GROUP BY cra.id ORDER BY attributeCount DESC' + (
-                                  ' LIMIT :count' if count is not None else ''),
-                              dict(count=count) if count is not None else {})
+async def get_rating_attributes(request: Request, response: Response,
+                                limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: str = '',
+                                count: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE)):
+    """Most used attributes first. count is the older name for limit"""
+    not_modified = await check_not_modified(request, response, RATING_ATTRIBUTE_ENTITY)
+    if not_modified:
+        return not_modified
+    limit = count or limit
+    args = dict(limit=limit + 1)
+    having = ''
+    if after:
+        args['afterCount'], args['afterID'] = decode_cursor(after, (int, int))
+        having = 'HAVING usageCount < :afterCount OR (usageCount = :afterCount AND cra.id > :afterID) '
+    # Usage comes from the per-course aggregates rather than counting every rating value
+    rows = await db.fetch_all('SELECT COALESCE(SUM(agg.ratingCount), 0) AS usageCount, cra.id, name, description '
+                              'FROM CourseRatingAttribute cra '
+                              'LEFT JOIN CourseRatingAggregate agg ON agg.attributeID = cra.id '
+                              'GROUP BY cra.id ' + having +
+                              'ORDER BY usageCount DESC, cra.id LIMIT :limit', args)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(int(rows[-1][0]), rows[-1][1])
+    set_page_headers(response, next_cursor, await approximate_count('CourseRatingAttribute'))
     return [
         CourseRatingAttributeInfo(id=attribute_id, name=name, description=description, usageCount=usage_count)
         for usage_count, attribute_id, name, description in rows
@@ -509,21 +820,9 @@ class Correlation(BaseModel):
 
 @router.get('/ratingCorrelation', response_model=List[Correlation])
 async def get_rating_correlation(account: Account = Depends(auth_account)):
-    import pymysql
-    c = pymysql.connect(
-        host=DATABASE_URL.hostname,
-        user=DATABASE_URL.username,
-        password=DATABASE_URL.password,
-        database=DATABASE_URL.database
-    )
-    cur = c.cursor()
-    cur.execute('CALL compute_correlation(%s)', account.id)
-    rows = cur.fetchall()
-    cur.close()
     return [
         Correlation(attrID=attr_id, correlation=correlation)
-        for attr_id, correlation in rows
-        if correlation is not None
+        for attr_id, correlation in await get_account_correlations(account.id)
     ]
 
 
@@ -533,4 +832,5 @@ async def post_rating_attribute(rating_attribute: RatingAttribute, account: Acco
         'INSERT INTO CourseRatingAttribute(name, description) VALUES (:name, :description)',
         dict(name=rating_attribute.name, description=rating_attribute.description)
     )
+    await bump_versions(RATING_ATTRIBUTE_ENTITY)
     return CourseRatingAttribute(id=rating_attribute_id, **rating_attribute.dict())
@@ -1,3 +1,4 @@
+import re
 from typing import Optional, List
 
 from fastapi.params import Query
@@ -30,6 +31,13 @@ class University(UniversityBase):
     id: int
 
 
+class AutocompleteResult(BaseModel):
+    type: str
+    code: str
+    name: str
+    universityCode: str = ''
+
+
 ###############
 # Account
 
@@ -52,6 +60,13 @@ class PublicAccount(AccountBase):
     id: int
 
 
+class CacheStats(BaseModel):
+    hits: int
+    misses: int
+    size: int
+    maxsize: int
+
+
 ###############
 # Course
 
@@ -66,6 +81,16 @@ class CourseIn(CourseBase):
     code: str = Query(..., max_length=20, regex="^[A-Za-z]+ *[0-9]+$")
 
 
+def parse_course_code(course_code):
+    m = re.match(r'([A-Za-z]+) *([0-9]+)', course_code)
+    assert m
+    return m.group(1).upper(), m.group(2)
+
+
+def format_course_code(course_code):
+    return '{} {}'.format(*parse_course_code(course_code))
+
+
 class CourseUpdateIn(CourseBase):
     pass
 
@@ -112,6 +137,16 @@ class CourseRatingIn(BaseModel):
     newRatingAttributes: List[RatingAttributeIn] = []
 
 
+class BulkCourseRatingIn(CourseRatingIn):
+    universityCode: str
+    courseCode: str
+
+
+class BulkResult(BaseModel):
+    status: int
+    detail: str = ''
+
+
 class RatingAttributeValueInfo(BaseModel):
     attributeID: int
     average: float
@@ -133,3 +168,4 @@ class CourseReview(BaseModel):
 class CourseRatingInfo(BaseModel):
     attributes: List[RatingAttributeValueInfo]
     reviews: List[CourseReview]
+    nextCursor: Optional[str] = None
@@ -0,0 +1,180 @@
+import asyncio
+import math
+import re
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from . import db
+from .config import SEARCH_REFRESH_SECONDS
+
+FIELD_WEIGHTS = dict(code=3.0, title=2.0, description=1.0)
+MAX_PREFIX_EXPANSIONS = 50
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_word_re = re.compile(r'[a-z]+|[0-9]+')
+_suffixes = ['ational', 'ation', 'ments', 'ment', 'ness', 'ings', 'ing', 'ies', 'ers', 'er', 'ed', 'ly', 'es', 's']
+# Plurals add "es" only after these, so the "e" of "courses" belongs to the word
+_sibilants = ('ss', 'x', 'z', 'ch', 'sh')
+# Words ending in these keep a final "s", like "class", "campus" and "analysis"
+_kept_before_s = ('s', 'u', 'i')
+
+
+def stem(word: str) -> str:
+    """
+    Strip common English suffixes so "programming", "programs" and "program" match
+
+    >>> [stem(word) for word in ['course', 'courses', 'class', 'classes', 'database', 'databases', 'box', 'boxes']]
+    ['course', 'course', 'class', 'class', 'database', 'database', 'box', 'box']
+    >>> [stem(word) for word in ['lecture', 'lectures', 'theory', 'theories', 'campus', 'analysis']]
+    ['lecture', 'lecture', 'theory', 'theory', 'campus', 'analysis']
+    """
+    if word.isdigit():
+        return word
+    for suffix in _suffixes:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            base = word[:-len(suffix)]
+            if suffix == 'es' and not base.endswith(_sibilants) or suffix == 's' and base.endswith(_kept_before_s):
+                continue
+            word = base + ('y' if suffix == 'ies' else '')
+            if len(word) > 3 and word[-1] == word[-2] and word[-1] not in 'lsz':
+                word = word[:-1]
+            break
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    return _word_re.findall(text.lower())
+
+
+class SearchIndex:
+    """BM25-ranked inverted index over the courses of one university"""
+
+    def __init__(self):
+        self.postings = defaultdict(dict)  # type: Dict[str, Dict[str, float]]
+        self.doc_terms = {}  # type: Dict[str, Dict[str, float]]
+        self.doc_lengths = {}  # type: Dict[str, float]
+        self.total_length = 0.0
+        # Unstemmed words seen and their terms, for matching the prefix the user is still typing. Never
+        # pruned, but rebuilt with the index
+        self.vocabulary = {}  # type: Dict[str, str]
+        self._sorted_words = None  # type: Optional[List[str]]
+
+    def add(self, code: str, title: str, description: str):
+        self.remove(code)
+        terms = defaultdict(float)
+        for field, text in [('code', code), ('title', title), ('description', description)]:
+            for word in tokenize(text):
+                if word not in self.vocabulary:
+                    self.vocabulary[word] = stem(word)
+                    self._sorted_words = None
+                terms[self.vocabulary[word]] += FIELD_WEIGHTS[field]
+        for term, weight in terms.items():
+            self.postings[term][code] = weight
+        self.doc_terms[code] = terms
+        self.doc_lengths[code] = sum(terms.values())
+        self.total_length += self.doc_lengths[code]
+
+    def remove(self, code: str):
+        terms = self.doc_terms.pop(code, None)
+        if terms is None:
+            return
+        for term in terms:
+            docs = self.postings[term]
+            del docs[code]
+            if not docs:
+                del self.postings[term]
+        self.total_length -= self.doc_lengths.pop(code)
+
+    def expand_prefix(self, prefix: str) -> List[str]:
+        """Terms of the words starting with prefix, compared unstemmed so "programm" finds "programming" """
+        if self._sorted_words is None:
+            self._sorted_words = sorted(self.vocabulary)
+        terms = set()
+        for word in self._sorted_words[bisect_left(self._sorted_words, prefix):]:
+            if not word.startswith(prefix) or len(terms) >= MAX_PREFIX_EXPANSIONS:
+                break
+            terms.add(self.vocabulary[word])
+        return list(terms)
+
+    def score_term(self, term: str, scores: Dict[str, float]):
+        docs = self.postings.get(term, {})
+        num_docs = len(self.doc_terms)
+        avg_length = self.total_length / num_docs
+        idf = math.log(1 + (num_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+        for code, weight in docs.items():
+            norm = 1 - BM25_B + BM25_B * self.doc_lengths[code] / avg_length
+            scores[code] = max(scores.get(code, 0.0), idf * weight * (BM25_K1 + 1) / (weight + BM25_K1 * norm))
+
+    def search(self, query: str, limit: int) -> List[str]:
+        """Course codes matching every query word, the last one as a prefix, best first"""
+        words = _word_re.findall(query.lower())
+        if not words or not self.doc_terms:
+            return []
+        totals = None
+        for i, word in enumerate(words):
+            candidates = {stem(word), word}
+            if i == len(words) - 1:
+                candidates.update(self.expand_prefix(word))
+            scores = {}
+            for term in candidates:
+                self.score_term(term, scores)
+            if totals is None:
+                totals = scores
+            else:
+                totals = {code: totals[code] + score for code, score in scores.items() if code in totals}
+        ranked = sorted(totals.items(), key=lambda x: (-x[1], x[0]))
+        return [code for code, _ in ranked[:limit]]
+
+
+indexes = defaultdict(SearchIndex)  # type: Dict[int, SearchIndex]
+_refresh_task = None  # type: Optional[asyncio.Future]
+
+
+def index_course(university_id: int, code: str, title: str, description: str):
+    indexes[university_id].add(code, title, description)
+
+
+def remove_course(university_id: int, code: str):
+    if university_id in indexes:
+        indexes[university_id].remove(code)
+
+
+def search_courses(university_id: int, query: str, limit: int) -> List[str]:
+    if university_id not in indexes:
+        return []
+    return indexes[university_id].search(query, limit)
+
+
+async def rebuild_search_index():
+    global indexes
+    new_indexes = defaultdict(SearchIndex)
+    for university_id, code, title, description in await db.fetch_all(
+        'SELECT universityID, code, title, description FROM Course'
+    ):
+        new_indexes[university_id].add(code, title, description)
+    indexes = new_indexes
+
+
+async def refresh_loop():
+    # Picks up courses written through other worker processes
+    while True:
+        await asyncio.sleep(SEARCH_REFRESH_SECONDS)
+        try:
+            await rebuild_search_index()
+        except Exception:
+            logger.exception('Failed to refresh search index')
+
+
+async def load_search_index():
+    global _refresh_task
+    await rebuild_search_index()
+    _refresh_task = asyncio.ensure_future(refresh_loop())
+
+
+async def stop_search_index():
+    if _refresh_task:
+        _refresh_task.cancel()
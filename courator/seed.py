@@ -0,0 +1,141 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+from syncer import sync
+
+from . import db
+from .aggregates import rebuild_aggregates
+from .hashing import get_pwd_context
+from .config import BCRYPT_ROUNDS
+from .queries import insert_many
+
+BATCH_SIZE = 1000
+SEED_PASSWORD = 'password'
+DEPARTMENTS = ['CS', 'MATH', 'PHYS', 'CHEM', 'BIO', 'ECON', 'HIST', 'ENG', 'PSYC', 'ME', 'EE', 'STAT']
+TOPICS = ['Introduction to', 'Advanced', 'Topics in', 'Foundations of', 'Applied', 'Theory of', 'Seminar in']
+SUBJECTS = ['Algorithms', 'Data Structures', 'Linear Algebra', 'Mechanics', 'Organic Chemistry', 'Genetics',
+            'Macroeconomics', 'Modern History', 'Writing', 'Cognition', 'Thermodynamics', 'Circuits', 'Statistics',
+            'Machine Learning', 'Databases', 'Operating Systems', 'Calculus', 'Probability', 'Networks']
+DEFAULT_ATTRIBUTES = [
+    {'name': 'Difficulty', 'description': 'How hard you found the course'},
+    {'name': 'Curriculum', 'description': 'How well the course was layed out'},
+    {'name': 'Usefulness', 'description': 'How applicable the course is to the real world'},
+    {'name': '_Overall', 'description': 'Overall course rating'}
+]
+# How much each attribute follows a course's underlying quality, Difficulty running against it
+ATTRIBUTE_QUALITY_WEIGHTS = dict(Difficulty=-0.6, Curriculum=0.8, Usefulness=0.7, _Overall=1.0)
+
+
+async def insert_batches(table: str, rows: list):
+    for i in range(0, len(rows), BATCH_SIZE):
+        await db.execute(*insert_many(table, rows[i:i + BATCH_SIZE]))
+
+
+async def next_id(table: str) -> int:
+    return (await db.fetch_val('SELECT COALESCE(MAX(id), 0) FROM {}'.format(table))) + 1
+
+
+async def get_attribute_ids() -> dict:
+    """Ids of the default rating attributes, creating any that are missing"""
+    rows = dict(await db.fetch_all('SELECT name, id FROM CourseRatingAttribute'))
+    missing = [attribute for attribute in DEFAULT_ATTRIBUTES if attribute['name'] not in rows]
+    if missing:
+        await insert_batches('CourseRatingAttribute', missing)
+        rows = dict(await db.fetch_all('SELECT name, id FROM CourseRatingAttribute'))
+    return {attribute['name']: rows[attribute['name']] for attribute in DEFAULT_ATTRIBUTES}
+
+
+def stars(latent: np.ndarray) -> np.ndarray:
+    """Map latent scores around 0 onto 0-5 stars, stored as fractions like submitted ratings"""
+    return np.clip(np.round(3.2 + 1.3 * latent), 0, 5) / 5.0
+
+
+@sync
+async def seed_db(universities: int, courses: int, ratings: int, accounts: int, prefix: str, seed: int):
+    """
+    Generate universities, courses spread evenly across them, and ratings of courses chosen with a
+    long-tailed popularity, from accounts with their own leniency. Each attribute's values follow a
+    hidden per-course quality to a different degree, like real ratings do
+    """
+    rng = np.random.default_rng(seed)
+    start = datetime.utcnow()
+    async with db:
+        attribute_ids = await get_attribute_ids()
+        async with db.transaction():
+            print('Creating {} universities...'.format(universities))
+            university_id = await next_id('University')
+            university_ids = list(range(university_id, university_id + universities))
+            await insert_batches('University', [
+                dict(id=i, code='{}{}'.format(prefix, n), name='{} University {}'.format(prefix.title(), n),
+                     description='A generated university', website='https://example.edu/{}'.format(n))
+                for n, i in enumerate(university_ids)
+            ])
+
+            print('Creating {} courses...'.format(courses))
+            course_keys = []
+            course_rows = []
+            for n in range(courses):
+                department = DEPARTMENTS[n % len(DEPARTMENTS)]
+                code = '{}{}'.format(department, 100 + n // len(DEPARTMENTS))
+                course_keys.append((university_ids[n % universities], code))
+                course_rows.append(dict(
+                    universityID=course_keys[-1][0], code=code, departmentCode=department,
+                    title='{} {}'.format(rng.choice(TOPICS), rng.choice(SUBJECTS)),
+                    description='A generated course covering {}.'.format(', '.join(rng.choice(SUBJECTS, 3))),
+                    website=''
+                ))
+            await insert_batches('Course', course_rows)
+
+            print('Creating {} accounts...'.format(accounts))
+            password_hash = get_pwd_context(BCRYPT_ROUNDS).hash(SEED_PASSWORD)
+            account_id = await next_id('Account')
+            account_ids = list(range(account_id, account_id + accounts))
+            await insert_batches('Account', [
+                dict(id=i, name='Student {}'.format(n), email='{}{}@example.edu'.format(prefix.lower(), n),
+                     passwordHash=password_hash, about='')
+                for n, i in enumerate(account_ids)
+            ])
+
+        print('Creating {} ratings...'.format(ratings))
+        quality = rng.normal(0, 1, courses)
+        leniency = rng.normal(0, 0.4, accounts)
+        popularity = 1 / np.arange(1, courses + 1) ** 0.8
+        popularity = rng.permutation(popularity / popularity.sum())
+        pairs = set()
+        while len(pairs) < min(ratings, courses * accounts):
+            needed = min(ratings, courses * accounts) - len(pairs)
+            pairs.update(zip(rng.choice(courses, needed, p=popularity).tolist(),
+                             rng.integers(0, accounts, needed).tolist()))
+        pairs = sorted(pairs)
+        rating_id = await next_id('CourseRating')
+        value_id = await next_id('CourseRatingValue')
+        dates = rng.integers(0, 3 * 365 * 24 * 3600, len(pairs))
+        for batch_start in range(0, len(pairs), BATCH_SIZE):
+            batch = pairs[batch_start:batch_start + BATCH_SIZE]
+            course_idx = np.array([course for course, _ in batch])
+            account_idx = np.array([account for _, account in batch])
+            rating_rows = []
+            value_rows = []
+            for n, (course, account) in enumerate(batch):
+                university, code = course_keys[course]
+                rating_rows.append(dict(
+                    id=rating_id + n, description='Generated review {}'.format(rating_id + n),
+                    date=(start - timedelta(seconds=int(dates[batch_start + n]))).strftime('%Y-%m-%d %H:%M:%S'),
+                    accountID=account_ids[account], universityID=university, courseCode=code
+                ))
+            for name, weight in ATTRIBUTE_QUALITY_WEIGHTS.items():
+                latent = weight * quality[course_idx] + leniency[account_idx] + rng.normal(0, 0.6, len(batch))
+                for n, value in enumerate(stars(latent).tolist()):
+                    value_rows.append(dict(id=value_id, courseRatingID=rating_id + n,
+                                           courseRatingAttributeID=attribute_ids[name], value=value))
+                    value_id += 1
+            async with db.transaction():
+                await insert_batches('CourseRating', rating_rows)
+                await insert_batches('CourseRatingValue', value_rows)
+            rating_id += len(batch)
+            print('Created {} of {} ratings'.format(batch_start + len(batch), len(pairs)))
+
+        print('Rebuilding "CourseRatingAggregate"...')
+        await rebuild_aggregates()
+    print('Done. Accounts log in as {}N@example.edu with password "{}". Run build-recommendations to '
+          'include the new ratings in suggestions'.format(prefix.lower(), SEED_PASSWORD))
@@ -0,0 +1,49 @@
+import json
+from typing import Callable, List, Sequence, Type
+
+from pydantic import BaseModel
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:  # Optional, see the "fast" extra in setup.py
+    orjson = None
+
+RowMapper = Callable[[Sequence], dict]
+
+
+def compile_mapper(model: Type[BaseModel], columns: List[str]) -> RowMapper:
+    """
+    Build a function turning a row with the given columns into the dict that model would serialize
+    to, in the model's field order, without constructing or validating the model. Every field must be
+    among the columns, which must already have the field's type. Other columns are left out
+    """
+    fields = list(model.__fields__)
+    missing = set(fields) - set(columns)
+    if missing:
+        raise ValueError('{} fields {} are not among the columns'.format(model.__name__, ', '.join(sorted(missing))))
+    source = 'lambda row: {{{}}}'.format(', '.join(
+        '{!r}: row[{}]'.format(field, columns.index(field)) for field in fields
+    ))
+    return eval(source)
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+class FastJSONResponse(Response):
+    """JSON response for content that is already plain dicts and lists, encoded with orjson when available"""
+    media_type = 'application/json'
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def fast_response(content, response: Response) -> FastJSONResponse:
+    """Bypass response_model validation, keeping headers a route already set on its injected response"""
+    fast = FastJSONResponse(content)
+    fast.headers.update(response.headers)
+    return fast
@@ -0,0 +1,156 @@
+import os
+import sqlite3
+from datetime import datetime
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from syncer import sync
+
+from . import db
+from .export import CHUNK_SIZE, iterate_table
+
+# Tables the read routes use as (name, SQLite definition, key columns to copy them in order). Codes and emails
+# are NOCASE to compare like MySQL's default collation does
+SNAPSHOT_TABLES = [
+    ('University', '''CREATE TABLE University(
+        id INTEGER NOT NULL PRIMARY KEY,
+        code TEXT NOT NULL UNIQUE COLLATE NOCASE,
+        name TEXT NOT NULL,
+        description TEXT NOT NULL,
+        website TEXT
+    )''', ['id']),
+    ('Course', '''CREATE TABLE Course(
+        universityID INTEGER NOT NULL,
+        code TEXT NOT NULL COLLATE NOCASE,
+        title TEXT NOT NULL,
+        description TEXT NOT NULL,
+        website TEXT NOT NULL,
+        departmentCode TEXT NOT NULL,
+        professorID INTEGER,
+        PRIMARY KEY (universityID, code)
+    )''', ['universityID', 'code']),
+    ('CourseMetadata', '''CREATE TABLE CourseMetadata(
+        universityID INTEGER NOT NULL,
+        courseCode TEXT NOT NULL COLLATE NOCASE,
+        iconUrl TEXT NOT NULL,
+        websiteUrl TEXT NOT NULL,
+        catalogUrl TEXT NOT NULL,
+        fetchedAt DATETIME NOT NULL,
+        PRIMARY KEY (universityID, courseCode)
+    )''', ['universityID', 'courseCode']),
+    ('Icon', '''CREATE TABLE Icon(
+        hash TEXT NOT NULL PRIMARY KEY,
+        contentType TEXT NOT NULL,
+        data BLOB NOT NULL
+    )''', ['hash']),
+    ('EntityVersion', '''CREATE TABLE EntityVersion(
+        entity TEXT NOT NULL PRIMARY KEY,
+        version INTEGER NOT NULL
+    )''', ['entity']),
+    ('Account', '''CREATE TABLE Account(
+        id INTEGER NOT NULL PRIMARY KEY,
+        name TEXT NOT NULL,
+        email TEXT NOT NULL UNIQUE COLLATE NOCASE,
+        passwordHash TEXT NOT NULL,
+        about TEXT NOT NULL,
+        permissions INTEGER NOT NULL
+    )''', ['id']),
+    ('CourseRating', '''CREATE TABLE CourseRating(
+        id INTEGER NOT NULL PRIMARY KEY,
+        description TEXT NOT NULL,
+        date DATETIME NOT NULL,
+        accountID INTEGER NOT NULL,
+        universityID INTEGER NOT NULL,
+        courseCode TEXT NOT NULL COLLATE NOCASE
+    )''', ['id']),
+    ('CourseRatingAttribute', '''CREATE TABLE CourseRatingAttribute(
+        id INTEGER NOT NULL PRIMARY KEY,
+        name TEXT NOT NULL,
+        description TEXT
+    )''', ['id']),
+    ('CourseRatingValue', '''CREATE TABLE CourseRatingValue(
+        id INTEGER NOT NULL PRIMARY KEY,
+        courseRatingID INTEGER NOT NULL,
+        courseRatingAttributeID INTEGER NOT NULL,
+        value REAL NOT NULL
+    )''', ['id']),
+    ('CourseRatingAggregate', '''CREATE TABLE CourseRatingAggregate(
+        universityID INTEGER NOT NULL,
+        courseCode TEXT NOT NULL COLLATE NOCASE,
+        attributeID INTEGER NOT NULL,
+        ratingCount INTEGER NOT NULL,
+        valueSum REAL NOT NULL,
+        valueSquareSum REAL NOT NULL,
+        PRIMARY KEY (universityID, courseCode, attributeID)
+    )''', ['universityID', 'courseCode', 'attributeID']),
+]
+# Created after the rows are in, which is faster than maintaining them while copying
+SNAPSHOT_INDEXES = [
+    'CREATE INDEX Course_department ON Course(universityID, departmentCode)',
+    'CREATE INDEX CourseRating_course ON CourseRating(universityID, courseCode, date, id)',
+    'CREATE INDEX CourseRating_account ON CourseRating(accountID)',
+    'CREATE INDEX CourseRatingAttribute_name ON CourseRatingAttribute(name)',
+    'CREATE INDEX CourseRatingValue_rating ON CourseRatingValue(courseRatingID)',
+]
+# Writes a read-only node still serves, since logging in only reads the account
+READ_ONLY_POSTS = {'/token'}
+
+
+def to_sqlite(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+async def copy_table(conn: sqlite3.Connection, table: str, create_sql: str, keys: list) -> int:
+    conn.execute(create_sql)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info({})'.format(table))]
+    insert_sql = 'INSERT INTO {} VALUES ({})'.format(table, ', '.join('?' * len(columns)))
+    rows = []
+    count = 0
+    async for row in iterate_table(table, columns, keys):
+        rows.append(tuple(to_sqlite(value) for value in row))
+        if len(rows) >= CHUNK_SIZE:
+            conn.executemany(insert_sql, rows)
+            count += len(rows)
+            rows = []
+    conn.executemany(insert_sql, rows)
+    return count + len(rows)
+
+
+@sync
+async def create_snapshot(path: str):
+    """
+    Copy the tables the read routes use into an indexed SQLite file for "courator run --snapshot".
+    The file is built beside path and moved over it when complete, so servers never see a partial one
+    """
+    temp_path = path + '.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    conn = sqlite3.connect(temp_path)
+    try:
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        async with db:
+            # One transaction gives every table the same consistent view of the database
+            async with db.transaction():
+                for table, create_sql, keys in SNAPSHOT_TABLES:
+                    count = await copy_table(conn, table, create_sql, keys)
+                    print('Copied {} rows of "{}"'.format(count, table))
+        print('Creating indexes...')
+        for index_sql in SNAPSHOT_INDEXES:
+            conn.execute(index_sql)
+        conn.execute('ANALYZE')
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(temp_path, path)
+    print('Wrote "{}"'.format(path))
+
+
+async def reject_writes(request: Request, call_next):
+    """Middleware for servers reading a snapshot, which can't apply changes"""
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and request.url.path not in READ_ONLY_POSTS:
+        return JSONResponse({'detail': 'This server only serves reads'}, status_code=405,
+                            headers={'Allow': 'GET, HEAD'})
+    return await call_next(request)
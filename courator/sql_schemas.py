@@ -1,8 +1,11 @@
+import re
 from enum import Enum
+from typing import Optional
 
 from syncer import sync
 
 from . import db
+from .aggregates import rebuild_aggregates
 
 
 class Obj(Enum):
@@ -12,6 +15,9 @@ class Obj(Enum):
 
 
 schemas = [
+    ('''CREATE TABLE SchemaVersion(
+        version INTEGER NOT NULL
+    )''', 'SchemaVersion', Obj.table),
     ('''CREATE TABLE University(
         id INTEGER NOT NULL AUTO_INCREMENT PRIMARY KEY,
         code VARCHAR(20) NOT NULL UNIQUE,
@@ -31,6 +37,27 @@ schemas = [
         
         PRIMARY KEY (universityID, code)
     )''', 'Course', Obj.table),
+    ('CREATE INDEX Course_department ON Course(universityID, departmentCode)', 'Course_department', Obj.index),
+    ('''CREATE TABLE CourseMetadata(
+        universityID INTEGER NOT NULL REFERENCES University,
+        courseCode VARCHAR(16) NOT NULL,
+
+        iconUrl MEDIUMTEXT NOT NULL,
+        websiteUrl VARCHAR(2000) NOT NULL,
+        catalogUrl VARCHAR(2000) NOT NULL,
+        fetchedAt DATETIME NOT NULL,
+
+        PRIMARY KEY (universityID, courseCode)
+    )''', 'CourseMetadata', Obj.table),
+    ('''CREATE TABLE Icon(
+        hash CHAR(64) NOT NULL PRIMARY KEY,
+        contentType VARCHAR(100) NOT NULL,
+        data MEDIUMBLOB NOT NULL
+    )''', 'Icon', Obj.table),
+    ('''CREATE TABLE EntityVersion(
+        entity VARCHAR(120) NOT NULL PRIMARY KEY,
+        version BIGINT NOT NULL
+    )''', 'EntityVersion', Obj.table),
     ('''CREATE TABLE Professor(
         id INTEGER NOT NULL AUTO_INCREMENT PRIMARY KEY,
         name VARCHAR(40) NOT NULL,
@@ -60,17 +87,32 @@ schemas = [
         universityID INTEGER NOT NULL REFERENCES University,
         courseCode VARCHAR(16) NOT NULL
     )''', 'CourseRating', Obj.table),
+    ('CREATE INDEX CourseRating_course ON CourseRating(universityID, courseCode, date, id)',
+     'CourseRating_course', Obj.index),
+    ('CREATE INDEX CourseRating_account ON CourseRating(accountID)', 'CourseRating_account', Obj.index),
     ('''CREATE TABLE CourseRatingAttribute(
         id INTEGER NOT NULL AUTO_INCREMENT PRIMARY KEY,
         name VARCHAR(40) NOT NULL,
         description VARCHAR(200)
     )''', 'CourseRatingAttribute', Obj.table),
+    ('CREATE INDEX CourseRatingAttribute_name ON CourseRatingAttribute(name)', 'CourseRatingAttribute_name', Obj.index),
     ('''CREATE TABLE CourseRatingValue(
         id INTEGER NOT NULL AUTO_INCREMENT PRIMARY KEY,
         courseRatingID INTEGER NOT NULL REFERENCES CourseRating,
         courseRatingAttributeID INTEGER NOT NULL REFERENCES CourseRatingAttribute,
         value DOUBLE NOT NULL
     )''', 'CourseRatingValue', Obj.table),
+    ('CREATE INDEX CourseRatingValue_rating ON CourseRatingValue(courseRatingID)', 'CourseRatingValue_rating', Obj.index),
+    ('''CREATE TABLE CourseRatingAggregate(
+        universityID INTEGER NOT NULL REFERENCES University,
+        courseCode VARCHAR(16) NOT NULL,
+        attributeID INTEGER NOT NULL REFERENCES CourseRatingAttribute,
+        ratingCount INTEGER NOT NULL,
+        valueSum DOUBLE NOT NULL,
+        valueSquareSum DOUBLE NOT NULL,
+
+        PRIMARY KEY (universityID, courseCode, attributeID)
+    )''', 'CourseRatingAggregate', Obj.table),
 
     ('''CREATE TABLE ProfessorRating(
         id INTEGER NOT NULL AUTO_INCREMENT PRIMARY KEY,
@@ -120,9 +162,8 @@ schemas = [
         courseID INTEGER NOT NULL REFERENCES Course,
         PRIMARY KEY(taID, courseID)
     )''', 'TACourse', Obj.table),
-    ('''DROP PROCEDURE IF EXISTS compute_correlation;
-DELIMITER ;;
-CREATE PROCEDURE compute_correlation(input_account_id INTEGER)
+    # Optional, the correlation route computes this in-process (see courator/correlation.py)
+    ('''CREATE PROCEDURE compute_correlation(input_account_id INTEGER)
 BEGIN
     WITH RValues AS (
         SELECT crv.courseRatingAttributeID AS attrID, crv.value AS value, cr.id AS rID
@@ -180,25 +221,97 @@ BEGIN
     FROM Correlation c
     JOIN CourseRatingAttribute cra ON cra.id = c.attrID
     WHERE cra.name != '_Overall';
-END;;
-DELIMITER ;''', 'compute_suggestions', Obj.function)
+END''', 'compute_correlation', Obj.function)
+]
+
+# Forward-only changes to databases created before they were added to schemas above. Migration N
+# brings a database at version N - 1 to version N. Steps are names of entries in schemas to
+# create (skipped if they already exist) or async functions to run
+migrations = [
+    ('Add rating aggregates', ['CourseRatingAggregate', rebuild_aggregates]),
+    ('Add course metadata', ['CourseMetadata']),
+    ('Add icons', ['Icon']),
+    ('Add entity versions', ['EntityVersion']),
+    ('Add secondary indexes', [
+        'CourseRating_course', 'CourseRating_account', 'CourseRatingValue_rating', 'CourseRatingAttribute_name',
+        'Course_department'
+    ]),
 ]
 
 
 @sync
-async def init_db():
+async def init_db(with_procedures=False):
     async with db:
-        for sql_query, name, _ in schemas:
+        for sql_query, name, obj_type in schemas:
+            if obj_type == Obj.function and not with_procedures:
+                continue
             print('Creating "{}"...'.format(name))
             await db.execute(sql_query)
+        await db.execute('INSERT INTO SchemaVersion(version) VALUES (:version)', dict(version=len(migrations)))
 
 
 @sync
 async def delete_db():
     import warnings
     warnings.filterwarnings("ignore", "Unknown table.*")
+    warnings.filterwarnings("ignore", "PROCEDURE .* does not exist")
     async with db:
         for _, name, obj_type in schemas:
             if obj_type == Obj.table:
                 print('Deleting "{}"...'.format(name))
                 await db.execute('DROP TABLE IF EXISTS {}'.format(name))
+            elif obj_type == Obj.function:
+                await db.execute('DROP PROCEDURE IF EXISTS {}'.format(name))
+
+
+async def table_exists(name: str) -> bool:
+    return bool(await db.fetch_all('SHOW TABLES LIKE :name', dict(name=name)))
+
+
+async def schema_exists(sql_query: str, name: str, obj_type: Obj) -> bool:
+    if obj_type == Obj.index:
+        table = re.search(r' ON (\w+)', sql_query).group(1)
+        return bool(await db.fetch_all('SHOW INDEX FROM {} WHERE Key_name = :name'.format(table), dict(name=name)))
+    return await table_exists(name)
+
+
+async def get_schema_version() -> Optional[int]:
+    """The applied migration count, or None for databases that haven't been initialized"""
+    if not await table_exists('SchemaVersion'):
+        if not await table_exists('University'):
+            return None
+        # Initialized before versioning existed, which is what the first migration expects
+        await db.execute(schemas[0][0])
+        await db.execute('INSERT INTO SchemaVersion(version) VALUES (0)')
+    return await db.fetch_val('SELECT version FROM SchemaVersion')
+
+
+@sync
+async def migrate_db():
+    by_name = {name: (sql_query, name, obj_type) for sql_query, name, obj_type in schemas}
+    async with db:
+        version = await get_schema_version()
+        if version is None:
+            print('Database is not initialized, run "init" instead')
+            raise SystemExit(1)
+        if version >= len(migrations):
+            print('Already at version {}'.format(version))
+        for version, (description, steps) in enumerate(migrations[version:], version + 1):
+            print('Migrating to version {}: {}...'.format(version, description))
+            for step in steps:
+                if callable(step):
+                    print('Running {}...'.format(step.__name__))
+                    await step()
+                elif await schema_exists(*by_name[step]):
+                    print('"{}" already exists'.format(step))
+                else:
+                    print('Creating "{}"...'.format(step))
+                    await db.execute(by_name[step][0])
+            await db.execute('UPDATE SchemaVersion SET version = :version', dict(version=version))
+
+
+@sync
+async def rebuild_aggregates_db():
+    async with db:
+        print('Rebuilding "CourseRatingAggregate"...')
+        await rebuild_aggregates()
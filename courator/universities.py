@@ -0,0 +1,64 @@
+import asyncio
+from typing import Dict, Optional
+
+from loguru import logger
+
+from . import db
+from .config import SEARCH_REFRESH_SECONDS
+from .loaders import university_loader
+
+_ids = {}  # type: Dict[str, int]
+_refresh_task = None  # type: Optional[asyncio.Future]
+
+
+def _key(university_code: str) -> str:
+    # University codes compare case-insensitively in MySQL, so the map does too
+    return university_code.lower()
+
+
+async def lookup_university_id(university_code: str) -> Optional[int]:
+    """The id of a university by code, from memory when possible, or None if it doesn't exist"""
+    key = _key(university_code)
+    if key not in _ids:
+        university = await university_loader.load(key)
+        if university is None:
+            return None
+        _ids[key] = university.id
+    return _ids[key]
+
+
+def set_university_id(university_code: str, university_id: int):
+    for key, value in list(_ids.items()):
+        if value == university_id:
+            del _ids[key]
+    _ids[_key(university_code)] = university_id
+
+
+def forget_university_code(university_code: str):
+    _ids.pop(_key(university_code), None)
+
+
+async def reload_university_ids():
+    global _ids
+    _ids = {_key(code): university_id for university_id, code in await db.fetch_all('SELECT id, code FROM University')}
+
+
+async def refresh_loop():
+    # Picks up university codes changed through other worker processes
+    while True:
+        await asyncio.sleep(SEARCH_REFRESH_SECONDS)
+        try:
+            await reload_university_ids()
+        except Exception:
+            logger.exception('Failed to refresh university ids')
+
+
+async def load_university_ids():
+    global _refresh_task
+    await reload_university_ids()
+    _refresh_task = asyncio.ensure_future(refresh_loop())
+
+
+async def stop_university_ids():
+    if _refresh_task:
+        _refresh_task.cancel()
@@ -31,11 +31,17 @@ setup(
         'uvicorn',
         'aiomysql',
         'pyjwt',
-        'httpx',
+        'httpx>=0.20',
         'syncer',
         'beautifulsoup4',
-        'async_lru'
+        'numpy',
+        'scipy',
+        'prometheus_client'
     ],
+    extras_require={
+        'fast': ['orjson'],
+        'snapshot': ['aiosqlite']
+    },
     entry_points={
         'console_scripts': [
             'courator=courator.__main__:main'